@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import pokalint
+from collections import OrderedDict
+
+WORDS = ["buffer", "color", "count", "index", "value", "table", "image", "frame", "size", "state"]
+TYPOS = ["convart", "fromat", "chagne", "pallet", "serch", "chack", "cash"]
+
+def generate_line(rnd, depth):
+    indent = "\t" * depth
+    name = rnd.choice(WORDS)
+    kind = rnd.random()
+    if kind < 0.25:
+        return "{0}int {1}{2} = {3};".format(indent, name, rnd.randint(0, 99), rnd.randint(0, 999))
+    if kind < 0.45:
+        return "{0}{1}_{2}({3}, {4});".format(indent, rnd.choice(["update", "get", "set", "draw"]), name, name, rnd.randint(0, 9))
+    if kind < 0.55:
+        return "{0}if ({1} < {2}) {{ return {3}; }}".format(indent, name, rnd.randint(0, 99), rnd.randint(0, 9))
+    if kind < 0.62:
+        return "{0}printf(\"{1} = %d\\n\", {1});".format(indent, name)
+    if kind < 0.70:
+        return "{0}// {1} the {2} before {3}".format(indent, rnd.choice(["Check", "Update", "Clear"]), name, rnd.choice(WORDS))
+    if kind < 0.72:
+        return "{0}strcpy({1}, \"{2}\");".format(indent, name, rnd.choice(WORDS))
+    if kind < 0.74:
+        return "{0}int {1} = atoi(\"{2}\");".format(indent, rnd.choice(TYPOS), rnd.randint(0, 99))
+    if kind < 0.80:
+        return "{0}for (int i = 0; i < {1}; i++) {{ {2}[i] = 0; }}".format(indent, rnd.randint(1, 64), name)
+    return ""
+
+def generate_source(rnd, lines):
+    """Return C/C++ like source text of about the given number of lines."""
+    out = ["// Generated by bench_pokalint.py", "", "#include <stdio.h>", ""]
+    while len(out) < lines:
+        out.append("int {0}_{1}(int {2})".format(rnd.choice(["update", "get", "set", "draw"]), rnd.choice(WORDS), rnd.choice(WORDS)))
+        out.append("{")
+        for i in range(min(lines - len(out), rnd.randint(5, 40))):
+            out.append(generate_line(rnd, 1))
+        out.append("\treturn 0;")
+        out.append("}")
+        out.append("")
+    return "\n".join(out[:lines]) + "\n"
+
+def generate_tree(root, files, lines, seed=0):
+    """Write a tree of C/C++ files and return their paths."""
+    rnd = random.Random(seed)
+    paths = []
+    for i in range(files):
+        directory = os.path.join(root, "src", "module{0}".format(i % 10))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "file{0}.{1}".format(i, rnd.choice(["c", "cpp", "h"])))
+        with open(path, mode="w", encoding="utf-8") as f:
+            f.write(generate_source(rnd, lines))
+        paths.append(path)
+    return paths
+
+def generate_diff(files, lines, seed=0):
+    """Return unified diff text that adds and replaces blocks in the given number of files."""
+    rnd = random.Random(seed)
+    out = []
+    for i in range(files):
+        name = "src/module{0}/file{1}.cpp".format(i % 10, i)
+        out.append("diff --git a/{0} b/{0}".format(name))
+        out.append("index 0000000..1111111 100644")
+        out.append("--- a/{0}".format(name))
+        out.append("+++ b/{0}".format(name))
+        lineno = 1
+        while lineno < lines:
+            added = [generate_line(rnd, 1) for j in range(rnd.randint(1, 8))]
+            deleted = [generate_line(rnd, 1) for j in range(rnd.randint(0, 2))]
+            out.append("@@ -{0},{1} +{0},{2} @@".format(lineno, len(deleted) + 2, len(added) + 2))
+            out.append(" {")
+            out.extend("-" + line for line in deleted)
+            out.extend("+" + line for line in added)
+            out.append(" }")
+            lineno += len(added) + rnd.randint(10, 50)
+    return "\n".join(out) + "\n"
+
+def generate_settings(path, rules, seed=0, base="pokalint_settings.json"):
+    """Write the base settings with additional warning rules, half text and half regex."""
+    rnd = random.Random(seed)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), base), encoding="utf-8") as f:
+        root = json.load(f, object_pairs_hook=OrderedDict)
+    words = set()
+    while len(words) < rules:
+        words.add("".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for i in range(rnd.randint(5, 10))))
+    words = sorted(words)
+    root["warning"]["Generated"] = [
+        word if i % 2 == 0 else "/\\b{0}_\\w+\\b/".format(word) for i, word in enumerate(words)]
+    with open(path, mode="w", encoding="utf-8") as f:
+        json.dump(root, f, ensure_ascii=False, indent=1)
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run(files=200, lines=500, rules=100, diff_files=200, repeat=3, seed=0):
+    """Run each stage 'repeat' times on a generated corpus and return the best timings."""
+    result = OrderedDict()
+    result["params"] = OrderedDict(files=files, lines=lines, rules=rules, diff_files=diff_files, repeat=repeat, seed=seed)
+    stages = OrderedDict()
+    with tempfile.TemporaryDirectory() as root:
+        settings_path = os.path.join(root, "pokalint_settings.json")
+        generate_settings(settings_path, rules, seed)
+        paths = generate_tree(root, files, lines, seed)
+        diff_lines = generate_diff(diff_files, lines, seed).splitlines(True)
+        total_lines = files * lines
+
+        def measure(name, func, line_count=None):
+            best = None
+            for i in range(repeat):
+                start = time.perf_counter()
+                value = func()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            stage = OrderedDict(seconds=round(best, 6))
+            if line_count:
+                stage["lines_per_sec"] = round(line_count / best) if best else None
+            stage["peak_rss_kb"] = peak_rss_kb()
+            stages[name] = stage
+            return value
+
+        settings = measure("settings", lambda: pokalint.Settings(settings_path))
+        settings.write_bundle(settings_path)
+        measure("settings_bundle", lambda: pokalint.Settings.load(settings_path))
+        def inspect_files():
+            inspector = pokalint.Inspector(settings)
+            for path in paths:
+                inspector.inspect_file(path)
+            return inspector.report
+        report = measure("inspect_file", inspect_files, total_lines)
+        def inspect_diff():
+            inspector = pokalint.Inspector(settings)
+            inspector.inspect_diff(diff_lines)
+            return inspector.report
+        measure("inspect_diff", inspect_diff, len(diff_lines))
+        measure("output", lambda: report.output(pokalint.Output(io.StringIO())))
+    result["stages"] = stages
+    return result
+
+def compare(result, baseline, tolerance):
+    """Return lines describing each stage against the baseline, and whether any is slower than tolerance."""
+    lines = []
+    regressed = False
+    for name, stage in result["stages"].items():
+        base = baseline["stages"].get(name)
+        if not base or not base["seconds"]:
+            lines.append("  * {0:12} - {1:10.6f} s".format(name, stage["seconds"]))
+            continue
+        ratio = stage["seconds"] / base["seconds"]
+        slower = 1 + tolerance < ratio
+        regressed = regressed or slower
+        lines.append("  * {0:12} - {1:10.6f} s ({2:+.1%} from {3:.6f} s){4}".format(
+            name, stage["seconds"], ratio - 1, base["seconds"], " SLOWER" if slower else ""))
+    if result["params"] != baseline.get("params"):
+        lines.append("  (Parameters differ from the baseline)")
+    return lines, regressed
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="Benchmark the inspection pipeline on a generated corpus.")
+    ap.add_argument("--files", type=int, default=200, help="Number of generated source files")
+    ap.add_argument("--lines", type=int, default=500, help="Lines per generated file")
+    ap.add_argument("--rules", type=int, default=100, help="Number of generated warning rules")
+    ap.add_argument("--diff-files", dest="diff_files", type=int, default=200, help="Number of files in the generated diff")
+    ap.add_argument("--repeat", type=int, default=3, help="Runs per stage, the best one is taken")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--save", metavar="FILE", help="Write the result as a baseline")
+    ap.add_argument("--compare", metavar="FILE", help="Compare with a baseline written by --save")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline (default: 0.2)")
+    args = ap.parse_args(argv[1:])
+
+    result = run(args.files, args.lines, args.rules, args.diff_files, args.repeat, args.seed)
+    if args.save:
+        with open(args.save, mode="w", encoding="utf-8") as f:
+            json.dump(result, f, indent=1)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            lines, regressed = compare(result, json.load(f), args.tolerance)
+        print("\n".join(lines))
+        return 1 if regressed else 0
+    print(json.dumps(result, indent=1))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
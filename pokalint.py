@@ -1,64 +1,338 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import re
 import sys
 import math
+import mmap
 import glob
+import fnmatch
+import itertools
 import json
-import argparse
-import datetime
+import codecs
+import time
+import pickle
+import hashlib
+import heapq
 import concolor
-import unicodedata
 from operator import itemgetter
-from collections import OrderedDict
+from collections import OrderedDict, deque
+
+# Modules only some paths need are imported where they are used, for a quick start:
+# argparse, contextlib, datetime, multiprocessing, pathlib, socket, sqlite3, subprocess, unicodedata
+
+_script_hash = None
+
+def script_hash():
+    """Return the hash of this script, stored data made by an other version is not used."""
+    global _script_hash
+    if _script_hash is None:
+        with open(__file__, mode="rb") as f:
+            _script_hash = hashlib.sha1(f.read()).hexdigest()
+    return _script_hash
+
+_char_widths = {}
+
+def relative_path(path, cwd):
+    """Return an absolute path under cwd as relative to it, other paths as they are."""
+    if os.path.isabs(path):
+        relative = os.path.relpath(path, cwd)
+        return path if relative.startswith("..") else relative
+    return path
 
 def strlen_on_screen(s):
+    if s.isascii():
+        return len(s)
+    import unicodedata
     sw = 0
     for c in s:
-        cw = unicodedata.east_asian_width(c)
-        sw += 2 if (cw == 'F' or cw == 'W' or cw == "A") else 1
+        w = _char_widths.get(c)
+        if w is None:
+            cw = unicodedata.east_asian_width(c)
+            w = _char_widths[c] = 2 if (cw == 'F' or cw == 'W' or cw == "A") else 1
+        sw += w
     return sw
 
+BOM_ENCODINGS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"))
+
+# Tried in order, EUC-JP before CP932 since most EUC-JP text is also valid CP932
+TRIAL_ENCODINGS = ("utf-8", "euc_jp", "cp932")
+
+def detect_encoding(sample, final=True):
+    """Guess the encoding of bytes from a BOM, then by trial decoding of the sample.
+
+    final: False if the sample is only the beginning of the data.
+    """
+    return _detect_encoding(sample, final)[0]
+
+def _detect_encoding(sample, final):
+    """Return (encoding, sample decoded by the successful trial or None)."""
+    for bom, encoding in BOM_ENCODINGS:
+        if sample.startswith(bom):
+            return encoding, None
+    if b"\0" in sample:
+        # UTF-16 without BOM, the zero bytes are the upper halves of ASCII characters
+        return "utf-16-be" if sample[::2].count(0) > sample[1::2].count(0) else "utf-16-le", None
+    if sample.isascii():
+        return "ascii", None
+    for encoding in TRIAL_ENCODINGS:
+        try:
+            return encoding, codecs.getincrementaldecoder(encoding)().decode(sample, final)
+        except UnicodeDecodeError:
+            pass
+    return "latin-1", None
+
+def decode_bytes(data, sample_size=65536):
+    """Return (text, encoding) for the bytes, decoding the whole data only once.
+
+    A trial decoding of the whole data is the result, only failed trials stop partway.
+    """
+    if len(data) <= sample_size:
+        encoding, text = _detect_encoding(data, True)
+    else:
+        encoding, text = _detect_encoding(data[:sample_size], False)
+        text = None
+    if text is not None:
+        return text, encoding
+    try:
+        return data.decode(encoding), encoding
+    except UnicodeDecodeError:
+        # The sample was misleading, fall back to the candidates for the whole data
+        encoding, text = _detect_encoding(data, True)
+        return text if text is not None else data.decode(encoding), encoding
+
+def split_lines(text):
+    """Split text into lines at any of CR+LF, CR or LF, like reading a file in text mode."""
+    lines = re.split("\r\n|\r|\n", text)
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+class DecodedLines(object):
+    """Iterates lines of a binary stream, decoded in the encoding detected from its beginning.
+
+    While the stream is pure ASCII the detection is deferred to the first chunk
+    containing other bytes, so the encoding attribute is final after iterating.
+    """
+    def __init__(self, stream, sample_size=65536):
+        self.__stream = stream
+        self.__sample_size = sample_size
+        self.__sample = stream.read(sample_size)
+        self.encoding = detect_encoding(self.__sample, len(self.__sample) < sample_size)
+
+    def __bool__(self):
+        return bool(self.__sample)
+
+    def __iter__(self):
+        newline_decoder = io.IncrementalNewlineDecoder(None, True)
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        rest = ""
+        chunk, self.__sample = self.__sample, b""
+        while chunk:
+            if self.encoding == "ascii" and not chunk.isascii():
+                self.encoding = detect_encoding(chunk, False)
+                decoder = codecs.getincrementaldecoder(self.encoding)()
+            lines = (rest + newline_decoder.decode(decoder.decode(chunk))).split("\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line + "\n"
+            chunk = self.__stream.read(self.__sample_size)
+        rest += newline_decoder.decode(decoder.decode(b"", True), True)
+        if rest:
+            yield rest
+
 class Output(object):
-    def __init__(self, file):
+    """Writes text to a file, in color if it is a terminal.
+
+    buffer_size: Text is written in chunks of this size, the rest on flush() or close().
+    background: Write the chunks from a thread, so a slow terminal or pipe doesn't hold up the caller.
+    """
+    def __init__(self, file, buffer_size=0, background=False):
         self.__file = file
-    
+        self.__tty = file.isatty()
+        self.__styles = {}
+        self.__buffer = []
+        self.__size = 0
+        self.__buffer_size = buffer_size
+        self.__queue = None
+        self.__thread = None
+        self.__error = None
+        if background:
+            import queue
+            import threading
+            self.__queue = queue.Queue(16)
+            self.__thread = threading.Thread(target=self.__write_queued, daemon=True)
+            self.__thread.start()
+
     def print(self, string="", style="", newline=True):
-        if self.__file.isatty():
-            bold = style.startswith("*")
-            color = style[1:] if bold else style
-            s = concolor.get(string, color, bold)
-        else:
-            s = string
-        print(s, end=("\n" if newline else ""), file=self.__file)
-    
+        if self.__tty and style:
+            affixes = self.__styles.get(style)
+            if affixes is None:
+                bold = style.startswith("*")
+                affixes = self.__styles[style] = concolor.get("\0", style[1:] if bold else style, bold).split("\0")
+            string = affixes[0] + string + affixes[1]
+        if newline:
+            string += "\n"
+        self.__buffer.append(string)
+        self.__size += len(string)
+        if self.__buffer_size <= self.__size:
+            self.__write()
+
     def isatty(self):
-        return self.__file.isatty()
+        return self.__tty
+
+    def flush(self):
+        self.__write()
+        if self.__queue is None:
+            self.__file.flush()
+
+    def close(self):
+        """Write out the rest and stop the thread."""
+        self.flush()
+        if self.__thread:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__queue = self.__thread = None
+            if self.__error:
+                raise self.__error
+
+    def __write(self):
+        if self.__buffer:
+            text = "".join(self.__buffer)
+            self.__buffer = []
+            self.__size = 0
+            if self.__queue is None:
+                self.__file.write(text)
+            else:
+                self.__queue.put(text)
+
+    def __write_queued(self):
+        while True:
+            text = self.__queue.get()
+            if text is None:
+                break
+            if self.__error is None:
+                try:
+                    self.__file.write(text)
+                    self.__file.flush()
+                except OSError as e:
+                    # Keep taking the text, the writer must not block
+                    self.__error = e
 
 class Pattern(object):
     def __init__(self, pattern):
+        self.__spec = pattern
         if type(pattern) is str:
-            self.__matcher = self.__get_matcher(pattern)
+            self.__regex, self.__flags, self.__literal = self.__parse(pattern)
             self.__message = None
             self.__filetypes = None
+            self.__region = None
+            self.__window = None
+            self.__unless = None
         else:
-            self.__matcher = self.__get_matcher(pattern.get("pattern"))
+            self.__regex, self.__flags, self.__literal = self.__parse(pattern.get("pattern"))
             self.__message = pattern.get("message")
             self.__filetypes = pattern.get("only")
+            self.__region = check_region(pattern.get("region"))
+            self.__window = pattern.get("window")
+            self.__unless = pattern.get("unless")
+            if self.__window is not None and (type(self.__window) is not int or self.__window < 1):
+                raise Exception("Invalid window {0} of '{1}', must be a positive number of lines".format(self.__window, pattern.get("pattern")))
+            if self.__window is not None and self.__region is not None:
+                raise Exception("'region' of '{0}' can't be used with a window".format(pattern.get("pattern")))
+            if self.__unless is not None:
+                if self.__window is None:
+                    raise Exception("'unless' of '{0}' needs a window".format(pattern.get("pattern")))
+                self.__unless = Pattern(self.__unless)
+        # Compiled on the first use, most patterns only run as part of a PatternMatcher
+        self.__compiled = None
+        self.__bytes_pattern = None
+
+    def __reduce__(self):
+        # Compiled matchers can't be pickled, rebuild them from the settings entry
+        return (Pattern, (self.__spec,))
 
     @property
     def message(self):
         return self.__message
 
+    @property
+    def regex(self):
+        return self.__regex
+
+    @property
+    def flags(self):
+        return self.__flags
+
+    @property
+    def literal(self):
+        return self.__literal
+
+    @property
+    def text(self):
+        """The text of a non-regex pattern, None for a regex."""
+        if not self.__literal:
+            return None
+        return self.__spec if type(self.__spec) is str else self.__spec.get("pattern")
+
+    @property
+    def region(self):
+        """The region of lines (see CLexer) this pattern is for, None for whole lines."""
+        return self.__region
+
+    @property
+    def window(self):
+        """The number of lines this pattern is matched across (see LineWindow), None for single lines."""
+        return self.__window
+
+    @property
+    def unless(self):
+        """The Pattern that clears a hit when it matches within the window."""
+        return self.__unless
+
+    @property
+    def bytes_regex(self):
+        """The regex for scanning UTF-8 buffers, raises UnicodeError if there is no equivalent."""
+        if self.__literal:
+            # An escaped text is still a literal byte sequence
+            return self.__regex.encode("utf-8")
+        # Non-ASCII in a regex could be inside a character class
+        return self.__regex.encode("ascii")
+
+    def is_applicable(self, filetype):
+        return not self.__filetypes or (filetype in self.__filetypes)
+
+    def compile(self):
+        """Return the compiled regex, raises re.error if it is invalid."""
+        if self.__compiled is None:
+            self.__compiled = re.compile(self.__regex, self.__flags)
+        return self.__compiled
+
     def match(self, s, filetype=None, fullmatch=False):
-        if not self.__filetypes or (filetype in self.__filetypes):
-            result = self.__matcher(s, fullmatch)
-            if result:
-                return {"pattern":self, "start":result[0], "end":result[1]}
+        if self.is_applicable(filetype):
+            compiled = self.__compiled or self.compile()
+            m = compiled.fullmatch(s) if fullmatch else compiled.search(s)
+            if m:
+                return {"pattern":self, "start":m.start(0), "end":m.end(0)}
         return None
-    
-    def __get_matcher(self, s):
+
+    def match_bytes(self, buf, pos, endpos, filetype=None):
+        """Search a line buf[pos:endpos] of a UTF-8 buffer, the span is returned as buffer offsets."""
+        if self.is_applicable(filetype):
+            if self.__bytes_pattern is None:
+                self.__bytes_pattern = re.compile(self.bytes_regex, self.__flags | re.M)
+            m = self.__bytes_pattern.search(buf, pos, endpos)
+            if m:
+                return {"pattern":self, "start":m.start(0), "end":m.end(0)}
+        return None
+
+    def __parse(self, s):
         flags = 0
         match = re.match(r"/(.+)/(\w*)", s)
         if match:
@@ -70,11 +344,469 @@ class Pattern(object):
         else:
             # Non regex pattern
             pattern_string = re.escape(s)
-        pattern = re.compile(pattern_string, flags)
-        def regex_matcher(s, fullmatch):
-            m = pattern.fullmatch(s) if fullmatch else pattern.search(s)
-            return (m.start(0), m.end(0)) if m else None
-        return regex_matcher
+        return pattern_string, flags, not match
+
+REGIONS = ("code", "comment", "string")
+# Region key of a PatternMatcher for all patterns regardless of their region
+ALL_REGIONS = "*"
+
+def check_region(region):
+    if region is not None and region not in REGIONS:
+        raise Exception("Invalid region '{0}', must be one of {1}".format(region, ", ".join(REGIONS)))
+    return region
+
+class CLexer(object):
+    """Splits lines of C/C++ source into code, comment and string regions.
+
+    The state (in a block comment, a continued string etc.) is kept from line
+    to line, so the lines of a file are given in order. String and character
+    literals are the "string" region without their quotes, which are code.
+    """
+    token_re = re.compile(r"/\*|//|(?:u8|[uUL])?R\"([^ ()\\\t]{0,16})\(|\"|'")
+    string_end_res = {"\"": re.compile(r'(?:[^"\\]|\\.)*"'), "'": re.compile(r"(?:[^'\\]|\\.)*'")}
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # None: code, "/*": block comment, "//": continued line comment,
+        # a quote: continued literal, ')delimiter"': raw string
+        self.__state = None
+
+    def spans(self, line):
+        """Return a list of (region, start, end) covering the line."""
+        spans = []
+        pos = 0
+        # Where to look for the next token, after a closing quote that is code already
+        scan = 0
+        length = len(line)
+        state = self.__state
+        while pos < length:
+            if state is None:
+                m = self.token_re.search(line, scan)
+                while m and m.group(0) == "'" and 0 < m.start() and line[m.start() - 1].isdigit():
+                    # A digit separator as in 1'000
+                    m = self.token_re.search(line, m.end())
+                if not m:
+                    spans.append(("code", pos, length))
+                    break
+                token = m.group(0)
+                if token == "/*":
+                    spans.append(("code", pos, m.start()))
+                    state = "/*"
+                    pos = m.start()
+                elif token == "//":
+                    spans.append(("code", pos, m.start()))
+                    spans.append(("comment", m.start(), length))
+                    state = "//" if line.endswith("\\") else None
+                    break
+                else:
+                    spans.append(("code", pos, m.end()))
+                    state = token if m.group(1) is None else ")" + m.group(1) + "\""
+                    pos = scan = m.end()
+            elif state == "/*":
+                end = line.find("*/", pos + 2 if line.startswith("/*", pos) else pos)
+                if end < 0:
+                    spans.append(("comment", pos, length))
+                    break
+                spans.append(("comment", pos, end + 2))
+                state = None
+                pos = scan = end + 2
+            elif state == "//":
+                spans.append(("comment", pos, length))
+                if not line.endswith("\\"):
+                    state = None
+                break
+            elif state in self.string_end_res:
+                m = self.string_end_res[state].match(line, pos)
+                if not m:
+                    spans.append(("string", pos, length))
+                    if not line.endswith("\\"):
+                        # Unterminated, or the next line continues it
+                        state = None
+                    break
+                spans.append(("string", pos, m.end() - 1))
+                state = None
+                pos = m.end() - 1
+                scan = m.end()
+            else:
+                end = line.find(state, pos)
+                if end < 0:
+                    spans.append(("string", pos, length))
+                    break
+                spans.append(("string", pos, end))
+                pos = end
+                scan = end + len(state)
+                state = None
+        if length == 0 and state == "//":
+            state = None
+        self.__state = state
+        return spans
+
+    def views(self, line, regions):
+        """Return {region: view} of the line for the regions, where the text out of the region is blank.
+
+        Views without anything but spaces are left out, None in regions stands for the line itself.
+        """
+        spans = self.spans(line)
+        views = {}
+        for region in regions:
+            if region is None:
+                views[None] = line
+            elif len(spans) == 1:
+                if spans[0][0] == region:
+                    views[region] = line
+            else:
+                view = "".join(line[start:end] if kind == region else " " * (end - start) for kind, start, end in spans)
+                if not view.isspace():
+                    views[region] = view
+        return views
+
+LEXERS = {"c": CLexer}
+
+class LineWindow(object):
+    """Evaluates the window rules of a filetype on lines as they come, keeping the last lines.
+
+    A rule with "unless" hits a line that matches its pattern, if neither the
+    line nor any of the next "window" lines matches "unless". A rule without it
+    is matched against the last "window" lines joined with "\\n", and hits where
+    a match ends on the newest line, so each match is found once.
+    Only lines fed as inspected (e.g. the added lines of a diff) can be hit,
+    other lines are only context: a match starting on a context line hits the
+    first inspected line it spans.
+    """
+    def __init__(self, rules):
+        # (index, name, Pattern) of the warning patterns
+        self.__joined_rules = [rule for rule in rules if rule[2].unless is None]
+        self.__unless_rules = [rule for rule in rules if rule[2].unless is not None]
+        self.__lines = deque(maxlen=max([rule[2].window for rule in self.__joined_rules] or [1]))
+        # Lines around a change needed to evaluate the rules
+        self.size = max(rule[2].window for rule in rules)
+        # (last line number, unless Pattern, hit) of the hits waiting for "unless"
+        self.__pending = []
+        self.__count = 0
+
+    def reset(self):
+        """Return the hits still waiting for the lines after them, and forget the lines."""
+        hits = [hit for deadline, unless, hit in self.__pending]
+        self.__pending = []
+        self.__lines.clear()
+        return hits
+
+    def feed(self, lineno, line, inspected=True):
+        """Return the hits found with the line, as (index, name, line number, start, end, text)."""
+        hits = []
+        self.__count += 1
+        if self.__pending:
+            pending = []
+            for entry in self.__pending:
+                if entry[0] < self.__count:
+                    hits.append(entry[2])
+                elif not entry[1].compile().search(line):
+                    pending.append(entry)
+            self.__pending = pending
+        if inspected:
+            for index, name, pattern in self.__unless_rules:
+                m = pattern.compile().search(line)
+                if m and not pattern.unless.compile().search(line):
+                    self.__pending.append((self.__count + pattern.window, pattern.unless, (index, name, lineno, m.start(), m.end(), line)))
+        self.__lines.append((lineno, line, inspected))
+        for index, name, pattern in self.__joined_rules:
+            lines = list(itertools.islice(self.__lines, max(0, len(self.__lines) - pattern.window), None))
+            text = "\n".join(entry[1] for entry in lines)
+            last_start = len(text) - len(line)
+            for m in pattern.compile().finditer(text):
+                if last_start <= m.end():
+                    offset = 0
+                    for entry_lineno, entry_line, entry_inspected in lines:
+                        end = offset + len(entry_line)
+                        if entry_inspected and m.start() <= end:
+                            hits.append((index, name, entry_lineno, max(0, m.start() - offset), min(m.end() - offset, len(entry_line)), entry_line))
+                            break
+                        offset = end + 1
+                    break
+        return hits
+
+def required_chars(regex):
+    """Return the set of characters that every match of the compiled regex contains.
+
+    Only what is plain from the parsed regex is found, it may be empty.
+    """
+    try:
+        from re import _parser as sre_parse
+    except ImportError:
+        import sre_parse
+    if type(regex.pattern) is not str or regex.flags & re.I:
+        return set()
+    repeats = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None))
+    def walk(items):
+        chars = set()
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                chars.add(chr(av))
+            elif op is sre_parse.SUBPATTERN and not av[1] & re.I:
+                chars |= walk(av[-1])
+            elif op in repeats and 1 <= av[0]:
+                chars |= walk(av[2])
+            elif op is sre_parse.BRANCH:
+                chars |= set.intersection(*[walk(branch) for branch in av[1]])
+        return chars
+    try:
+        return walk(sre_parse.parse(regex.pattern, regex.flags))
+    except Exception:
+        return set()
+
+class LiteralSet(object):
+    """Finds the first in order of many literal strings that occurs in a string.
+
+    The literals are merged into the regex of their trie, which matches the
+    longest literal at a position. The literals that are prefixes of it are
+    known in advance, so one pass over the string gives all literals found.
+    """
+    def __init__(self, entries):
+        # (index, text) of the literals in order
+        self.__text_by_index = dict(entries)
+        self.__index_by_text = {}
+        trie = {}
+        for index, text in entries:
+            self.__index_by_text.setdefault(text, index)
+            node = trie
+            for c in text:
+                node = node.setdefault(c, {})
+            node[""] = None
+        # Lowest index of the literals that are a prefix of each literal, itself included
+        self.__lowest_by_text = {}
+        for text in self.__index_by_text:
+            prefixes = (self.__index_by_text.get(text[:i]) for i in range(1, len(text) + 1))
+            self.__lowest_by_text[text] = min(index for index in prefixes if index is not None)
+        source = self.__trie_regex(trie)
+        self.__search = re.compile(source).search
+        self.__finditer = re.compile("(?=({0}))".format(source)).finditer
+
+    @staticmethod
+    def __trie_regex(node):
+        branches = [re.escape(c) + LiteralSet.__trie_regex(child) for c, child in sorted(node.items()) if c]
+        if not branches:
+            return ""
+        regex = branches[0] if len(branches) == 1 else "(?:{0})".format("|".join(branches))
+        return "(?:{0})?".format(regex) if "" in node else regex
+
+    def text(self, index):
+        return self.__text_by_index[index]
+
+    def lowest(self, s):
+        """Return the lowest index of the literals in s, or None."""
+        m = self.__search(s)
+        if not m:
+            return None
+        return min(self.__lowest_by_text[m.group(1)] for m in self.__finditer(s, m.start()))
+
+    def fullmatch(self, s):
+        """Return the lowest index of the literals equal to s, or None."""
+        return self.__index_by_text.get(s)
+
+class PatternMatcher(object):
+    """Matches a string against an ordered list of (name, Pattern) entries.
+
+    All patterns applicable to a filetype are merged into one alternation of
+    named groups, so a string without any hit is scanned only once. The first
+    entry in order that matches still wins, as with a plain sequential loop.
+    Many text patterns are left out of the alternation and looked for with a
+    LiteralSet, as the regex engine would try them one by one at each position.
+    """
+
+    # Patterns with back-references can't be renumbered into an alternation
+    unmergeable_re = re.compile(r"\\[1-9]|\(\?P=")
+    # Number of text patterns from which a LiteralSet is used
+    literal_set_min = 8
+
+    def __init__(self, entries):
+        self.__entries = entries
+        self.__compiled_by_filetype = {}
+        # Source of the combined regex (or None) by (filetype, binary), kept in a settings bundle
+        self.__sources = {}
+        self.__profiler = None
+        self.__label = None
+
+    def __getstate__(self):
+        return {"entries": self.__entries, "sources": self.__sources}
+
+    def __setstate__(self, state):
+        self.__init__(state["entries"])
+        self.__sources = state["sources"]
+
+    def prepare(self, filetypes):
+        for filetype in filetypes:
+            self.__get_compiled(filetype)
+
+    def set_profiler(self, profiler, label):
+        """Time each pattern separately with the RuleProfiler, this disables the combined regex."""
+        self.__profiler = profiler
+        self.__label = label
+
+    def regions(self, filetype):
+        """Return the set of regions of the patterns applicable to the filetype."""
+        return set(pattern.region for name, pattern in self.__entries if pattern.is_applicable(filetype) and not pattern.window)
+
+    def windows(self, filetype):
+        """Return [(index, name, pattern)] of the window patterns applicable to the filetype, see LineWindow."""
+        return [(i, name, pattern) for i, (name, pattern) in enumerate(self.__entries) if pattern.window and pattern.is_applicable(filetype)]
+
+    def match(self, s, filetype=None, fullmatch=False, views=None):
+        """views: Views of s by region made by a lexer (None for s itself), each one is matched only
+        with the patterns for the region. Without views the regions of the patterns are ignored.
+        """
+        if views is None:
+            return self.__match(s, filetype, fullmatch, self.__get_compiled(filetype))
+        best = None
+        for region, view in views.items():
+            compiled = self.__get_compiled(filetype, False, region)
+            if compiled[0]:
+                match = self.__match(view, filetype, fullmatch, compiled)
+                if match and (best is None or match["index"] < best["index"]):
+                    best = match
+        return best
+
+    def __match(self, s, filetype, fullmatch, compiled):
+        indexes, compiled, literals, rest = compiled
+        if self.__profiler:
+            return self.__match_profiled(indexes, s, filetype, fullmatch)
+        if literals is None:
+            return self.__match_combined(indexes, compiled, s, filetype, fullmatch)
+        hit = literals.fullmatch(s) if fullmatch else literals.lowest(s)
+        match = self.__match_combined(rest, compiled, s, filetype, fullmatch)
+        if hit is None or (match and match["index"] < hit):
+            return match
+        text = literals.text(hit)
+        start = 0 if fullmatch else s.find(text)
+        name, pattern = self.__entries[hit]
+        return {"pattern":pattern, "start":start, "end":start + len(text), "name":name, "index":hit}
+
+    def __match_combined(self, indexes, compiled, s, filetype, fullmatch):
+        if compiled is None:
+            return self.__match_sequential(indexes, s, filetype, fullmatch)
+        m = compiled.fullmatch(s) if fullmatch else compiled.search(s)
+        if not m:
+            return None
+        hit = int(m.lastgroup[1:])
+        # An earlier entry may still match further to the right
+        match = self.__match_sequential(indexes, s, filetype, fullmatch, hit)
+        if match:
+            return match
+        name, pattern = self.__entries[hit]
+        return {"pattern":pattern, "start":m.start(0), "end":m.end(0), "name":name, "index":hit}
+
+    def match_bytes(self, buf, pos, endpos, filetype=None):
+        """Same as match() for a line buf[pos:endpos] of a UTF-8 buffer, see Pattern.match_bytes."""
+        indexes, compiled = self.__get_compiled(filetype, True)[:2]
+        hit = None
+        if compiled is not None:
+            m = compiled.search(buf, pos, endpos)
+            if not m:
+                return None
+            hit = int(m.lastgroup[1:])
+        for i in indexes:
+            if hit == i:
+                name, pattern = self.__entries[hit]
+                return {"pattern":pattern, "start":m.start(0), "end":m.end(0), "name":name, "index":hit}
+            name, pattern = self.__entries[i]
+            match = pattern.match_bytes(buf, pos, endpos, filetype)
+            if match:
+                match["name"] = name
+                match["index"] = i
+                return match
+        return None
+
+    def check_bytes(self):
+        """Raise UnicodeError if some pattern can't be used with match_bytes()."""
+        for name, pattern in self.__entries:
+            pattern.bytes_regex
+
+    def __match_sequential(self, indexes, s, filetype, fullmatch, stop=None):
+        for i in indexes:
+            if stop is not None and stop <= i:
+                break
+            name, pattern = self.__entries[i]
+            match = pattern.match(s, filetype, fullmatch)
+            if match:
+                match["name"] = name
+                match["index"] = i
+                return match
+        return None
+
+    def __match_profiled(self, indexes, s, filetype, fullmatch):
+        set_name = None
+        set_elapsed = 0
+        match = None
+        for i in indexes:
+            name, pattern = self.__entries[i]
+            if name != set_name:
+                if set_name is not None:
+                    self.__profiler.record((self.__label, set_name, None), set_elapsed, False)
+                set_name = name
+                set_elapsed = 0
+            start = time.perf_counter()
+            match = pattern.match(s, filetype, fullmatch)
+            elapsed = time.perf_counter() - start
+            set_elapsed += elapsed
+            self.__profiler.record((self.__label, name, pattern.regex), elapsed, match)
+            if match:
+                match["name"] = name
+                match["index"] = i
+                break
+        if set_name is not None:
+            self.__profiler.record((self.__label, set_name, None), set_elapsed, match)
+        return match
+
+    def pattern(self, index):
+        return self.__entries[index][1]
+
+    def __get_compiled(self, filetype, binary=False, region=ALL_REGIONS):
+        key = (filetype, binary, region)
+        compiled = self.__compiled_by_filetype.get(key)
+        if compiled is None:
+            flags = re.M if binary else 0
+            source = self.__sources.get(key)
+            if source is None:
+                # Window patterns are left to LineWindow
+                indexes = [i for i, (name, pattern) in enumerate(self.__entries)
+                    if pattern.is_applicable(filetype) and region in (ALL_REGIONS, pattern.region) and not pattern.window]
+                literals = None
+                rest = indexes
+                if not binary:
+                    literals = [(i, self.__entries[i][1].text) for i in indexes if self.__entries[i][1].text]
+                    if len(literals) < self.literal_set_min:
+                        literals = None
+                    else:
+                        rest = [i for i in indexes if not self.__entries[i][1].text]
+                regex = self.__combine(rest, binary)
+                source = self.__sources[key] = (indexes, regex and regex.pattern, literals, rest)
+            else:
+                regex = source[1] and re.compile(source[1], flags)
+            compiled = (source[0], regex, source[2] and LiteralSet(source[2]), source[3])
+            self.__compiled_by_filetype[key] = compiled
+        return compiled
+
+    def __combine(self, indexes, binary):
+        """Return the combined regex, or None to match the patterns one by one."""
+        branches = []
+        for i in indexes:
+            pattern = self.__entries[i][1]
+            if self.unmergeable_re.search(pattern.regex):
+                branches = None
+                break
+            regex = "(?i:{0})".format(pattern.regex) if pattern.flags & re.I else pattern.regex
+            branches.append("(?P<_{0}>{1})".format(i, regex))
+        if branches:
+            combined = "|".join(branches)
+            try:
+                return re.compile(combined.encode("utf-8"), re.M) if binary else re.compile(combined)
+            except re.error:
+                pass
+        # The patterns are needed one by one, and this reports an invalid one
+        for i in indexes:
+            self.__entries[i][1].compile()
+        return None
 
 class PatternSet(object):
     def __init__(self, name, patterns):
@@ -84,95 +816,601 @@ class PatternSet(object):
             patterns = [patterns]
         for pattern in patterns:
             self.__patterns.append(Pattern(pattern))
+        self.__matcher = PatternMatcher([(name, pattern) for pattern in self.__patterns])
 
-    def match(self, s, filetype=None, fullmatch=False):
-        for pattern in self.__patterns:
-            match = pattern.match(s, filetype, fullmatch)
-            if match:
-                match["name"] = self.__name
-                return match
-        return None
+    @property
+    def patterns(self):
+        return self.__patterns
+
+    def prepare(self, filetypes):
+        self.__matcher.prepare(filetypes)
+
+    def set_profiler(self, profiler, label):
+        self.__matcher.set_profiler(profiler, label)
+
+    def match(self, s, filetype=None, fullmatch=False, views=None):
+        return self.__matcher.match(s, filetype, fullmatch, views)
+
+    def match_bytes(self, buf, pos, endpos, filetype=None):
+        return self.__matcher.match_bytes(buf, pos, endpos, filetype)
+
+    def check_bytes(self):
+        self.__matcher.check_bytes()
+
+class NameSet(object):
+    """Names matched as a whole, e.g. function names to exclude.
+
+    Text patterns are looked up in a set, only regex patterns (and ones for
+    specific filetypes, which never apply here) are matched one by one.
+    """
+    def __init__(self, patterns):
+        if type(patterns) is not list:
+            patterns = [patterns]
+        self.__names = set()
+        rest = []
+        for pattern in patterns:
+            text = pattern if type(pattern) is str else pattern.get("pattern") if not pattern.get("only") else None
+            if text is not None and Pattern(text).literal:
+                self.__names.add(text)
+            else:
+                rest.append(pattern)
+        self.__patternset = PatternSet(None, rest) if rest else None
+        if self.__patternset:
+            self.__patternset.prepare([None])
+
+    def __contains__(self, name):
+        return name in self.__names or bool(self.__patternset and self.__patternset.match(name, fullmatch=True))
+
+    def set_profiler(self, profiler, label):
+        if self.__patternset:
+            self.__patternset.set_profiler(profiler, label)
 
 class PatternGroup:
     def __init__(self, patternsets):
         self.__patternsets = OrderedDict()
+        entries = []
         for name in patternsets:
-            self.__patternsets[name] = PatternSet(name, patternsets[name])
-    
+            patternset = PatternSet(name, patternsets[name])
+            self.__patternsets[name] = patternset
+            entries.extend((name, pattern) for pattern in patternset.patterns)
+        self.__matcher = PatternMatcher(entries)
+
     def names(self):
         return self.__patternsets.keys()
 
-    def match(self, s, filetype=None, fullmatch=False):
-        for name in self.__patternsets:
-            match = self.__patternsets[name].match(s, filetype, fullmatch)
-            if match:
-                return match
-        return None
+    def patternset(self, name):
+        return self.__patternsets[name]
+
+    def pattern(self, index):
+        """Return the Pattern of the "index" in a match result."""
+        return self.__matcher.pattern(index)
+
+    def regions(self, filetype):
+        return self.__matcher.regions(filetype)
+
+    def windows(self, filetype):
+        return self.__matcher.windows(filetype)
+
+    def prepare(self, filetypes):
+        self.__matcher.prepare(filetypes)
+
+    def set_profiler(self, profiler, label):
+        self.__matcher.set_profiler(profiler, label)
+
+    def match(self, s, filetype=None, fullmatch=False, views=None):
+        return self.__matcher.match(s, filetype, fullmatch, views)
+
+    def match_bytes(self, buf, pos, endpos, filetype=None):
+        return self.__matcher.match_bytes(buf, pos, endpos, filetype)
+
+    def check_bytes(self):
+        self.__matcher.check_bytes()
 
 class Settings(object):
-    def __init__(self, settings_path):
-        root = json.load(open(settings_path), object_pairs_hook = OrderedDict)
+    """Rules loaded from the settings file.
+
+    Settings.load() uses a bundle made by write_bundle() if it is up to date.
+    It holds the parsed rules and the combined regex sources checked already,
+    the regexes are compiled only when a filetype is used first.
+    """
+
+    # Changed when the bundle format changes
+    BUNDLE_VERSION = 1
+
+    def __init__(self, settings_path, source=None):
+        if source is None:
+            with open(settings_path, mode="rb") as f:
+                source = f.read()
+        # Identifies the rule set, e.g. for the result cache
+        self.hash = hashlib.sha1(source).hexdigest()
+        root = json.loads(source.decode("utf-8"), object_pairs_hook = OrderedDict)
         self.filter = PatternGroup(root["filetype"])
         self.counter = PatternGroup(root["counter"])
         self.warning = PatternGroup(root["warning"])
+        self.__warning_source = root["warning"]
+        # Warning categories given to restrict()
+        self.restricted = None
+        self.__lexer_names = root.get("lexer", {})
+        for filetype, lexer_name in self.__lexer_names.items():
+            if lexer_name not in LEXERS:
+                raise Exception("Unknown lexer '{0}' for '{1}'".format(lexer_name, filetype))
+        self.__regions_by_filetype = {}
+        self.__windows_by_filetype = {}
         self.funcinfo_available = False
+        self.funcinfo_region = None
         function_settings = root["function-settings"]
         if function_settings:
+            self.funcinfo_region = check_region(function_settings.get("region"))
             self.funcdecl_re = re.compile(function_settings["declaration"][1:-1])
             self.funcdef_re = re.compile(function_settings["definition"][1:-1])
             self.funccall_re = re.compile(function_settings["call"][1:-1])
-            self.funcname_exclude_set = PatternSet(None, function_settings["exclude"])
+            self.funcname_exclude_set = NameSet(function_settings["exclude"])
+            # Lines without these can't have any of the three
+            self.funcinfo_chars = tuple(required_chars(self.funcdecl_re) & required_chars(self.funcdef_re) & required_chars(self.funccall_re))
             self.funcinfo_available = True
+        self.__bytes_available = None
+        self.__filetype_by_extension = {}
+        filetypes = [None] + list(self.filter.names())
+        self.filter.prepare([None])
+        self.counter.prepare(filetypes)
+        self.warning.prepare(filetypes)
+
+    def lexer(self, filetype):
+        """Return a new lexer for the filetype and the regions to view, or (None, None) if lines aren't lexed.
+
+        Lines are lexed only if some pattern for the filetype has a region.
+        """
+        regions = self.__regions_by_filetype.get(filetype, False)
+        if regions is False:
+            regions = None
+            if filetype in self.__lexer_names:
+                regions = self.counter.regions(filetype) | self.warning.regions(filetype)
+                if self.funcinfo_available:
+                    regions.add(self.funcinfo_region)
+                # None (for whole lines) comes first
+                regions = tuple(sorted(regions, key = lambda region: region or "")) if regions != {None} else None
+            self.__regions_by_filetype[filetype] = regions
+        return (LEXERS[self.__lexer_names[filetype]](), regions) if regions else (None, None)
+
+    def window(self, filetype):
+        """Return a new LineWindow for the window rules of the warnings for the filetype, or None if there are none."""
+        rules = self.__windows_by_filetype.get(filetype)
+        if rules is None:
+            rules = self.__windows_by_filetype[filetype] = self.warning.windows(filetype)
+        return LineWindow(rules) if rules else None
+
+    @staticmethod
+    def bundle_path(settings_path):
+        return os.path.splitext(settings_path)[0] + ".bundle"
+
+    @staticmethod
+    def load(settings_path):
+        """Return the Settings from the bundle if it was made from the current settings file, or from the file."""
+        with open(settings_path, mode="rb") as f:
+            source = f.read()
+        try:
+            with open(Settings.bundle_path(settings_path), mode="rb") as f:
+                if f.readline() == Settings.__bundle_header(source):
+                    return pickle.load(f)
+        except (OSError, EOFError, AttributeError, ImportError, IndexError, TypeError, pickle.UnpicklingError):
+            # A bundle of an other version or a broken one, the settings file is parsed
+            pass
+        return Settings(settings_path, source)
+
+    def write_bundle(self, settings_path):
+        """Write the bundle for Settings.load() and return its path."""
+        with open(settings_path, mode="rb") as f:
+            source = f.read()
+        if hashlib.sha1(source).hexdigest() != self.hash:
+            raise Exception("The settings file has been changed")
+        bundle_path = Settings.bundle_path(settings_path)
+        temp_path = bundle_path + ".tmp"
+        with open(temp_path, mode="wb") as f:
+            f.write(Settings.__bundle_header(source))
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, bundle_path)
+        return bundle_path
+
+    @staticmethod
+    def __bundle_header(source):
+        return "pokalint-settings {0} {1} {2}\n".format(
+            Settings.BUNDLE_VERSION, hashlib.sha1(source).hexdigest(), script_hash()).encode("ascii")
+
+    def filetype(self, path):
+        """Return the filetype name of the path or None.
+
+        The "filetype" patterns run only once per file extension (or per file
+        name without extension), so they are expected to classify by it.
+        """
+        extension = os.path.splitext(path)[1] or os.path.basename(path)
+        try:
+            return self.__filetype_by_extension[extension]
+        except KeyError:
+            match = self.filter.match(path)
+            filetype = self.__filetype_by_extension[extension] = match and match["name"]
+            return filetype
+
+    def restrict(self, categories):
+        """Look only for the warning categories (all if empty), not for counters and functions."""
+        for category in categories:
+            if category not in self.warning.names():
+                raise Exception("Unknown warning category '{0}'".format(category))
+        self.restricted = list(categories)
+        if categories:
+            self.warning = PatternGroup(OrderedDict((name, self.__warning_source[name]) for name in categories))
+        self.counter = PatternGroup(OrderedDict())
+        self.funcinfo_available = False
+        self.__regions_by_filetype = {}
+        self.__windows_by_filetype = {}
+        self.__bytes_available = None
+        filetypes = [None] + list(self.filter.names())
+        self.counter.prepare(filetypes)
+        self.warning.prepare(filetypes)
+
+    def set_profiler(self, profiler):
+        """Record the time of every rule to the RuleProfiler."""
+        self.counter.set_profiler(profiler, "counter")
+        self.warning.set_profiler(profiler, "warning")
+        if self.funcinfo_available:
+            self.funcdecl_re = ProfiledRegex(self.funcdecl_re, profiler, ("function", "declaration", self.funcdecl_re.pattern))
+            self.funcdef_re = ProfiledRegex(self.funcdef_re, profiler, ("function", "definition", self.funcdef_re.pattern))
+            self.funccall_re = ProfiledRegex(self.funccall_re, profiler, ("function", "call", self.funccall_re.pattern))
+            self.funcname_exclude_set.set_profiler(profiler, "function/exclude")
+
+    def prepare_bytes(self):
+        """Compile the patterns for scanning memory-mapped UTF-8 files, False if some can't be."""
+        if self.__bytes_available is None:
+            try:
+                self.counter.check_bytes()
+                self.warning.check_bytes()
+                if self.funcinfo_available:
+                    self.funcdecl_bytes_re = re.compile(self.funcdecl_re.pattern.encode("ascii"), re.M)
+                    self.funcdef_bytes_re = re.compile(self.funcdef_re.pattern.encode("ascii"), re.M)
+                    self.funccall_bytes_re = re.compile(self.funccall_re.pattern.encode("ascii"), re.M)
+                    self.funcinfo_bytes_chars = tuple(c.encode("ascii") for c in self.funcinfo_chars)
+                self.__bytes_available = True
+            except (UnicodeError, re.error):
+                self.__bytes_available = False
+        return self.__bytes_available
+
+class RuleProfiler(object):
+    """Collects the time, call count and hit count of each rule.
+
+    The keys are (label, name, regex), a None regex stands for the whole PatternSet.
+    """
+    def __init__(self):
+        self.__stats = {}
+
+    def record(self, key, elapsed, hit):
+        stat = self.__stats.get(key)
+        if stat is None:
+            stat = self.__stats[key] = [0.0, 0, 0, 0.0]
+        stat[0] += elapsed
+        stat[1] += 1
+        if hit:
+            stat[2] += 1
+        if stat[3] < elapsed:
+            stat[3] = elapsed
+
+    def output(self, output, threshold, top=30):
+        """Output the top rules ranked by the total time, and all rules with a call slower than threshold seconds."""
+        output.print("# Rule profile", "cyan")
+        output.print()
+        output.isatty() or output.print("```")
+        pattern_counts = {}
+        for label, name, regex in self.__stats:
+            if regex is not None:
+                pattern_counts[(label, name)] = pattern_counts.get((label, name), 0) + 1
+        rows = [(key, stat) for key, stat in self.__stats.items()
+            # A set of one pattern is the same as the pattern
+            if key[2] is not None or 1 < pattern_counts.get(key[:2], 0)]
+        rows.sort(key = lambda row: row[1][0], reverse = True)
+        for rank, ((label, name, regex), (total, calls, hits, worst)) in enumerate(rows):
+            if top <= rank and worst <= threshold:
+                continue
+            rule = label + ("" if name is None else "/" + name) + ("" if regex is None else " " + regex)
+            if 50 < len(rule):
+                rule = rule[:47] + "..."
+            output.print("  * {0:50} - {1:9.3f} ms {2:8} calls {3:8} hits (worst {4:.3f} ms)".format(
+                rule, total * 1000, calls, hits, worst * 1000), "red" if threshold < worst else "")
+        output.isatty() or output.print("```")
+        output.print()
+        slow_count = sum(1 for key, stat in rows if threshold < stat[3])
+        if slow_count:
+            output.print("{0} rule(s) took more than {1} ms for a line.".format(slow_count, threshold * 1000), "red")
+            output.print()
+
+class ProfiledRegex(object):
+    """Wraps a compiled regex to record the time of search() and findall() to a RuleProfiler."""
+    def __init__(self, regex, profiler, key):
+        self.__regex = regex
+        self.__profiler = profiler
+        self.__key = key
+
+    @property
+    def pattern(self):
+        return self.__regex.pattern
+
+    def search(self, s, pos=0, endpos=sys.maxsize):
+        start = time.perf_counter()
+        m = self.__regex.search(s, pos, endpos)
+        self.__profiler.record(self.__key, time.perf_counter() - start, m)
+        return m
+
+    def findall(self, s, pos=0, endpos=sys.maxsize):
+        start = time.perf_counter()
+        matches = self.__regex.findall(s, pos, endpos)
+        self.__profiler.record(self.__key, time.perf_counter() - start, matches)
+        return matches
+
+class RulesBench(object):
+    """Measures the time and the hit rate of each PatternSet on sample lines, for "pokalint.py rules-bench".
+
+    The lines are matched in a worker process, which is killed if a match takes
+    longer than the timeout (catastrophic backtracking can't be interrupted
+    otherwise). Then the patterns of the PatternSet are tried one by one on the
+    line to find the slow ones, and the benchmark goes on with the next set.
+    """
+    def __init__(self, samples, timeout=0.1, repeat=3):
+        """samples: [(filetype, line)], see sample_lines()."""
+        self.samples = samples
+        self.timeout = timeout
+        self.repeat = repeat
+
+    @staticmethod
+    def sample_lines(settings, paths, count, seed=0):
+        """Return (up to count [(filetype, line)] picked at random from the files, number of files)."""
+        import random
+        rnd = random.Random(seed)
+        samples = []
+        seen = 0
+        file_count = 0
+        for path in paths:
+            try:
+                with open(path, mode="rb") as f:
+                    text = decode_bytes(f.read())[0]
+            except (OSError, UnicodeError):
+                continue
+            file_count += 1
+            filetype = settings.filetype(path)
+            for line in split_lines(text):
+                seen += 1
+                if len(samples) < count:
+                    samples.append((filetype, line))
+                else:
+                    # Reservoir sampling, every line has the same chance
+                    i = rnd.randrange(seen)
+                    if i < count:
+                        samples[i] = (filetype, line)
+        return samples, file_count
+
+    def run(self, settings):
+        """Return a row (dict) for each PatternSet of the counters and the warnings."""
+        jobs = []
+        for label, group in (("counter", settings.counter), ("warning", settings.warning)):
+            for name in group.names():
+                jobs.append((label, name, group.patternset(name)))
+        filetypes = [None] + list(settings.filter.names())
+        rows = self.__run(jobs, filetypes, self.samples, self.repeat)
+        for (label, name, patternset), row in zip(jobs, rows):
+            row["patterns"] = len(patternset.patterns)
+            if row["seconds"] is None:
+                # Find the slow patterns, each on its own
+                filetype, line = self.samples[row["timeout_line"]]
+                pattern_jobs = [(label, name, PatternMatcher([(name, pattern)])) for pattern in patternset.patterns]
+                pattern_rows = self.__run(pattern_jobs, filetypes, [(filetype, line)], 1)
+                row["timeout_line"] = line
+                row["timeout_patterns"] = [pattern_text(pattern)
+                    for pattern, pattern_row in zip(patternset.patterns, pattern_rows) if pattern_row["seconds"] is None]
+        return rows
+
+    def __run(self, jobs, filetypes, samples, repeat):
+        import multiprocessing
+        rows = []
+        while len(rows) < len(jobs):
+            first = len(rows)
+            # [job, line] the worker is matching, the job is counted from first
+            progress = multiprocessing.RawArray("q", [0, -1])
+            receiver, sender = multiprocessing.Pipe(False)
+            process = multiprocessing.Process(target=_rules_bench_worker,
+                args=(jobs[first:], filetypes, samples, repeat, progress, sender), daemon=True)
+            process.start()
+            sender.close()
+            state = None
+            since = time.monotonic()
+            try:
+                while len(rows) < len(jobs):
+                    if receiver.poll(min(0.01, self.timeout / 4)):
+                        rows.append(receiver.recv())
+                        continue
+                    current = (progress[0], progress[1])
+                    now = time.monotonic()
+                    if current != state:
+                        state, since = current, now
+                    elif self.timeout < now - since and not receiver.poll():
+                        row = OrderedDict(label=jobs[len(rows)][0], name=jobs[len(rows)][1], seconds=None)
+                        row["timeout_line"] = current[1]
+                        rows.append(row)
+                        break
+                    if not process.is_alive() and not receiver.poll():
+                        raise Exception("The benchmark process exited with {0}".format(process.exitcode))
+            finally:
+                process.kill()
+                process.join()
+                receiver.close()
+        return rows
+
+def _rules_bench_worker(jobs, filetypes, samples, repeat, progress, sender):
+    """Send a row for each job of a RulesBench, the progress shows the line being matched."""
+    for job, (label, name, matcher) in enumerate(jobs):
+        progress[0], progress[1] = job, -1
+        start = time.perf_counter()
+        matcher.prepare(filetypes)
+        compile_time = time.perf_counter() - start
+        # The first round takes the time of each line, the others only the total
+        hits = 0
+        worst = 0.0
+        best = 0.0
+        for i, (filetype, line) in enumerate(samples):
+            progress[1] = i
+            start = time.perf_counter()
+            match = matcher.match(line, filetype)
+            elapsed = time.perf_counter() - start
+            best += elapsed
+            if match:
+                hits += 1
+            if worst < elapsed:
+                worst = elapsed
+        for round in range(1, repeat):
+            start = time.perf_counter()
+            for i, (filetype, line) in enumerate(samples):
+                progress[1] = i
+                matcher.match(line, filetype)
+            best = min(best, time.perf_counter() - start)
+        sender.send(OrderedDict(label=label, name=name, seconds=best, hits=hits, worst=worst, compile=compile_time))
+    sender.close()
+
+def pattern_text(pattern):
+    """Return the pattern as written in the settings file."""
+    return pattern.text if pattern.literal else "/{0}/".format(pattern.regex)
+
+class InspectionStopped(Exception):
+    """Raised by the Inspector when max_hits warnings are found."""
+    pass
 
 class Inspector(object):
-    def __init__(self, settings):
+    def __init__(self, settings, listener=None, mmap_threshold=None, max_warnings=None, max_funccalls=None, max_hits=None):
+        """listener: Called with a partial Report each time a file or a diff file-section is finished.
+        mmap_threshold: Size in bytes from which UTF-8 files are scanned memory-mapped, None to disable.
+        max_warnings: Number of warnings kept per category, the rest is only counted.
+        max_funccalls: Number of function names counted, the counts get approximate over it.
+        max_hits: Number of warnings after which InspectionStopped is raised.
+        """
         self.__settings = settings
+        self.__mmap_threshold = mmap_threshold
+        self.__max_warnings = max_warnings
+        self.__max_funccalls = max_funccalls
+        self.__max_hits = max_hits
+        self.__hit_count = 0
         self.__current_filename = None
         self.__current_filetype = None
         self.__current_lineno = 0
-        self.__report = Report(self.__settings)
+        self.__lexer = None
+        self.__regions = None
+        self.__window = None
+        # Lines of files are read again for output, but diff text is gone by then
+        self.__keep_text = False
+        self.__report = Report(self.__settings, max_warnings, max_funccalls)
+        self.__listener = listener
+        self.__section = Report(self.__settings, max_warnings, max_funccalls) if listener else self.__report
 
     @property
     def report(self):
         return self.__report
 
     def inspect_file(self, path):
-        with open(path, mode="r", encoding="utf-8") as f:
-            lines = f.readlines()
-        self.__report.increase_file_count(os.path.splitext(path)[1])
-        self.__current_filename = os.path.abspath(path)
-        match = self.__settings.filter.match(self.__current_filename)
-        self.__current_filetype = match and match["name"]
-        self.__current_lineno = 1
+        self.__keep_text = False
+        with open(path, mode="rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            # An empty file can't be mapped
+            if self.__mmap_threshold is not None and self.__mmap_threshold <= size and size:
+                if self.__inspect_mapped_file(path, f):
+                    self.__finish_section()
+                    return
+            text, encoding = decode_bytes(f.read())
+        lines = split_lines(text)
+        del text
+        self.__begin_file(path, encoding)
         for line in lines:
-            self.__inspect_line(line.rstrip("\r\n"))
+            self.__inspect_line(line)
             self.__current_lineno += 1
-        self.__report.non_diff_line_count += len(lines)
+        self.__section.non_diff_line_count += len(lines)
+        self.__finish_section()
+
+    def __begin_file(self, path, encoding):
+        self.__current_filename = os.path.abspath(path)
+        self.__section.increase_file_count(self.__current_filename)
+        self.__section.set_encoding(self.__current_filename, encoding)
+        self.__set_filetype(self.__settings.filetype(self.__current_filename))
+        self.__current_lineno = 1
+
+    def __set_filetype(self, filetype):
+        self.__current_filetype = filetype
+        self.__lexer, self.__regions = self.__settings.lexer(filetype)
+        self.__window = self.__settings.window(filetype) if filetype else None
+
+    def __inspect_mapped_file(self, path, f):
+        """Scan the lines of a large UTF-8 file in place, without decoding it as a whole.
+
+        The patterns run as bytes regexes on each line of the mapped buffer, so
+        \\w, \\b etc. only regard ASCII characters. Returns False if the file or
+        the settings don't allow it.
+        """
+        filetype = self.__settings.filetype(path)
+        if not self.__settings.prepare_bytes() or self.__settings.lexer(filetype)[0] or self.__settings.window(filetype):
+            # Lexed lines and window rules are left to the normal path as well
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            sample = buf[:65536]
+            encoding = detect_encoding(sample, len(buf) <= len(sample))
+            if encoding not in ("ascii", "utf-8", "utf-8-sig") or (b"\r" in sample and b"\r\n" not in sample):
+                # Other encodings and CR line endings are left to the normal path
+                return False
+            self.__begin_file(path, encoding)
+            start = len(codecs.BOM_UTF8) if encoding == "utf-8-sig" else 0
+            pos = start
+            size = len(buf)
+            while pos < size:
+                end = buf.find(b"\n", pos)
+                next_pos = end + 1
+                if end < 0:
+                    end = next_pos = size
+                if pos < end and buf[end - 1] == 0x0d:
+                    end -= 1
+                if pos == start and start:
+                    # "^" doesn't match right after the BOM, the first line is scanned as a copy of its own
+                    self.__inspect_buffer_line(buf[pos:end], 0, end - pos)
+                else:
+                    self.__inspect_buffer_line(buf, pos, end)
+                self.__current_lineno += 1
+                pos = next_pos
+            self.__section.non_diff_line_count += self.__current_lineno - 1
+        return True
 
     def inspect_diff(self, lines):
-        if not self.__is_diff(lines):
+        """Inspect unified diff text given as any iterable of lines, consuming it as it goes."""
+        lines = iter(lines)
+        head = list(itertools.islice(lines, 4))
+        if not self.__is_diff(head):
             raise Exception("Invalid diff format")
+        self.__keep_text = True
         filename_re = re.compile(r"^\+\+\+ +(?:b/)?(.+\.\w+).*")
         lineno_re = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)")
         add_count = 0
         delete_count = 0
-        for line in lines:
+        for line in itertools.chain(head, lines):
             if line.startswith("---"):
                 pass
             elif line.startswith("+++"):
+                self.__finish_section()
                 filename = filename_re.match(line).group(1)
-                if self.__settings.filter.match(filename):
-                    self.__current_filename = filename_re.match(line).group(1)
-                    match = self.__settings.filter.match(self.__current_filename)
-                    self.__current_filetype = match and match["name"]
-                    self.__report.increase_file_count(os.path.splitext(filename)[1])
+                filetype = self.__settings.filetype(filename)
+                if filetype:
+                    self.__current_filename = filename
+                    self.__set_filetype(filetype)
+                    self.__section.increase_file_count(filename)
                 else:
                     self.__current_filename = None
-                    self.__current_filetype = None
+                    self.__set_filetype(None)
             elif line.startswith("@@"):
                 add_count = 0
                 self.__current_lineno = int(lineno_re.match(line).group(1))
                 delete_count = 0
+                if self.__lexer:
+                    # The lines before the hunk are unknown
+                    self.__lexer.reset()
+                if self.__window:
+                    self.__reset_window()
             else:
                 if line.startswith("-"):
                     delete_count += 1
@@ -181,20 +1419,100 @@ class Inspector(object):
                     if self.__current_filename:
                         self.__inspect_line(line[1:].rstrip("\r\n"))
                 else:
+                    if line.startswith(" ") and (self.__lexer or self.__window):
+                        # Context lines carry the state to the next added lines
+                        context = line[1:].rstrip("\r\n")
+                        if self.__lexer:
+                            self.__lexer.spans(context)
+                        if self.__window:
+                            self.__feed_window(context, False)
                     if 0 < add_count:
                         if delete_count == 0:
-                            self.__report.pure_added_line_count += add_count
-                            self.__report.added_block_count += 1
+                            self.__section.pure_added_line_count += add_count
+                            self.__section.added_block_count += 1
                         else:
-                            self.__report.replace_added_line_count += add_count
-                            self.__report.replace_deleted_line_count += delete_count
-                            self.__report.replaced_block_count += 1
+                            self.__section.replace_added_line_count += add_count
+                            self.__section.replace_deleted_line_count += delete_count
+                            self.__section.replaced_block_count += 1
                     elif 0 < delete_count:
-                        self.__report.pure_deleted_line_count += delete_count
-                        self.__report.deleted_block_count += 1
+                        self.__section.pure_deleted_line_count += delete_count
+                        self.__section.deleted_block_count += 1
                     add_count = 0
                     delete_count = 0
                 self.__current_lineno += 1
+        self.__finish_section()
+
+    def inspect_hunks(self, filename, hunks, lines=None):
+        """Inspect the added lines of one changed file, without diff text.
+
+        hunks: (deleted count, added start, added count) of each hunk of a
+               diff without context lines, as in "@@ -a,DELETED +START,ADDED @@".
+        lines: Lines of the new version of the file. Can be None if the
+               filename has no filetype.
+        """
+        self.__keep_text = True
+        filetype = self.__settings.filetype(filename)
+        if filetype:
+            self.__current_filename = filename
+            self.__set_filetype(filetype)
+            self.__section.increase_file_count(filename)
+        lexed_count = 0
+        # Number of the last line fed to the window, None before the first hunk
+        fed = None
+        for delete_count, start, add_count in hunks:
+            if filetype:
+                if self.__lexer:
+                    # The whole file is there, so the state is known from the beginning
+                    for line in lines[lexed_count:start - 1]:
+                        self.__lexer.spans(line)
+                    lexed_count = max(lexed_count, start - 1 + add_count)
+                if self.__window:
+                    size = self.__window.size
+                    if fed is not None and start - 1 - size <= fed + size:
+                        # The context lines of the hunks meet, so each line is fed once
+                        self.__feed_context(lines, fed, start - 1)
+                    else:
+                        if fed is not None:
+                            self.__feed_context(lines, fed, fed + size)
+                            self.__reset_window()
+                        self.__feed_context(lines, start - 1 - size, start - 1)
+                for self.__current_lineno in range(start, min(start + add_count, len(lines) + 1)):
+                    self.__inspect_line(lines[self.__current_lineno - 1])
+                fed = max(fed or 0, start - 1 + add_count)
+            if 0 < add_count:
+                if delete_count == 0:
+                    self.__section.pure_added_line_count += add_count
+                    self.__section.added_block_count += 1
+                else:
+                    self.__section.replace_added_line_count += add_count
+                    self.__section.replace_deleted_line_count += delete_count
+                    self.__section.replaced_block_count += 1
+            elif 0 < delete_count:
+                self.__section.pure_deleted_line_count += delete_count
+                self.__section.deleted_block_count += 1
+        if self.__window and fed is not None:
+            self.__feed_context(lines, fed, fed + self.__window.size)
+        self.__finish_section()
+
+    def __feed_context(self, lines, begin, end):
+        for self.__current_lineno in range(max(0, begin) + 1, min(end, len(lines)) + 1):
+            self.__feed_window(lines[self.__current_lineno - 1], False)
+
+    def __feed_window(self, line, inspected):
+        for index, name, lineno, start, end, text in self.__window.feed(self.__current_lineno, line, inspected):
+            self.__add_warning({"name": name, "index": index, "start": start, "end": end}, text, lineno)
+
+    def __reset_window(self):
+        for index, name, lineno, start, end, text in self.__window.reset():
+            self.__add_warning({"name": name, "index": index, "start": start, "end": end}, text, lineno)
+
+    def __finish_section(self):
+        if self.__window:
+            self.__reset_window()
+        if self.__listener:
+            self.__listener(self.__section)
+            self.__report.merge(self.__section)
+            self.__section = Report(self.__settings, self.__max_warnings, self.__max_funccalls)
 
     def __is_diff(self, lines):
         for i in range(min(3, len(lines) - 1)):
@@ -203,41 +1521,83 @@ class Inspector(object):
         return False
 
     def __inspect_line(self, line):
-        warning_match = self.__settings.warning.match(line, self.__current_filetype)
+        if self.__window:
+            self.__feed_window(line, True)
+        views = self.__lexer.views(line, self.__regions) if self.__lexer else None
+        if views is not None and not views:
+            # Nothing in the regions any rule is for, e.g. a comment line
+            return
+
+        warning_match = self.__settings.warning.match(line, self.__current_filetype, views=views)
         if warning_match:
-            warning = Warning()
-            warning.filename = self.__current_filename
-            warning.lineno = self.__current_lineno
-            warning.start = warning_match["start"]
-            warning.end = warning_match["end"]
-            warning.text = line.replace("\t", " ")
-            warning.pattern = warning_match["pattern"]
-            self.__report.add_warning(warning_match["name"], warning)
-
-        counter_match = self.__settings.counter.match(line, self.__current_filetype)
+            self.__add_warning(warning_match, line)
+
+        counter_match = self.__settings.counter.match(line, self.__current_filetype, views=views)
         if counter_match:
-            self.__report.increase_keyword_count(counter_match["name"])
+            self.__section.increase_keyword_count(counter_match["name"], self.__section.file_id(self.__current_filename))
 
         if self.__settings.funcinfo_available:
-            self.__inspect_line_function(line)
+            view = line if views is None else views.get(self.__settings.funcinfo_region)
+            if view:
+                self.__inspect_line_function(view)
+
+    def __inspect_buffer_line(self, buf, pos, endpos):
+        warning_match = self.__settings.warning.match_bytes(buf, pos, endpos, self.__current_filetype)
+        if warning_match:
+            # The span is converted to character offsets
+            warning_match["end"] = len(buf[pos:warning_match["end"]].decode("utf-8", "replace"))
+            warning_match["start"] = len(buf[pos:warning_match["start"]].decode("utf-8", "replace"))
+            self.__add_warning(warning_match, None)
 
-    def __inspect_line_function(self, line):
-        decl_match = self.__settings.funcdecl_re.search(line)
-        if decl_match and not self.__settings.funcname_exclude_set.match(decl_match.group(1), fullmatch=True):
-            self.__report.add_funcdecl(decl_match.group(1))
+        counter_match = self.__settings.counter.match_bytes(buf, pos, endpos, self.__current_filetype)
+        if counter_match:
+            self.__section.increase_keyword_count(counter_match["name"], self.__section.file_id(self.__current_filename))
+
+        if self.__settings.funcinfo_available:
+            settings = self.__settings
+            self.__inspect_line_function(buf, pos, endpos,
+                (settings.funcdecl_bytes_re, settings.funcdef_bytes_re, settings.funccall_bytes_re), settings.funcinfo_bytes_chars)
+
+    def __add_warning(self, warning_match, line, lineno=None):
+        self.__section.add_warning(warning_match["name"], Warning(
+            self.__section.file_id(self.__current_filename),
+            lineno or self.__current_lineno,
+            warning_match["start"],
+            warning_match["end"],
+            warning_match["index"],
+            line if self.__keep_text else None))
+        self.__hit_count += 1
+        if self.__max_hits is not None and self.__max_hits <= self.__hit_count:
+            raise InspectionStopped()
+
+    def __inspect_line_function(self, line, pos=0, endpos=sys.maxsize, regexes=None, chars=None):
+        for c in (self.__settings.funcinfo_chars if chars is None else chars):
+            if line.find(c, pos, endpos) < 0:
+                return
+        decl_re, def_re, call_re = regexes or (self.__settings.funcdecl_re, self.__settings.funcdef_re, self.__settings.funccall_re)
+        decl_match = decl_re.search(line, pos, endpos)
+        decl_name = decl_match and self.__funcname(decl_match.group(1))
+        if decl_name:
+            self.__section.add_funcdecl(decl_name)
         else:
-            def_match = self.__settings.funcdef_re.search(line)
-            if def_match and not self.__settings.funcname_exclude_set.match(def_match.group(1), fullmatch=True):
-                self.__report.add_funcdef(def_match.group(1))
+            def_match = def_re.search(line, pos, endpos)
+            def_name = def_match and self.__funcname(def_match.group(1))
+            if def_name:
+                self.__section.add_funcdef(def_name)
             else:
-                matches = self.__settings.funccall_re.findall(line)
-                if matches:
-                    for match in matches:
-                        if not self.__settings.funcname_exclude_set.match(match, fullmatch=True):
-                            self.__report.increase_funccall_count(match)
+                for match in call_re.findall(line, pos, endpos):
+                    name = self.__funcname(match)
+                    if name:
+                        self.__section.increase_funccall_count(name)
+
+    def __funcname(self, name):
+        """Return the function name as str, or None if it is excluded."""
+        if type(name) is bytes:
+            name = name.decode("utf-8", "replace")
+        return None if name in self.__settings.funcname_exclude_set else name
 
 class Report(object):
-    def __init__(self, settings):
+    def __init__(self, settings, max_warnings=None, max_funccalls=None):
         self.non_diff_line_count = 0
         self.pure_added_line_count = 0
         self.pure_deleted_line_count = 0
@@ -247,23 +1607,85 @@ class Report(object):
         self.deleted_block_count = 0
         self.replaced_block_count = 0
         self.__file_count_by_extension = {}
+        # directory: DirectoryTotals of the files directly in it, and (file id, totals) of the last file counted
+        self.__totals_by_dir = {}
+        self.__last_dir_totals = (None, None)
+        self.__encoding_by_filename = {}
         self.__keyword_count_by_category = OrderedDict.fromkeys(settings.counter.names(), 0)
         self.__warnings_by_category = OrderedDict((n, []) for n in settings.warning.names())
-        self.__funccall_count_by_name = {}
+        self.__warning_count_by_category = OrderedDict.fromkeys(settings.warning.names(), 0)
+        # (file id, category): count, for the metrics of each file
+        self.__keyword_counts_by_file = {}
+        self.__warning_counts_by_file = {}
+        self.__max_warnings = max_warnings
+        self.__filenames = []
+        self.__file_ids = {}
+        # {file id: {line number: line}} of the warnings to output, a set of the line numbers until the file is read
+        self.__source_lines = None
+        self.__funccalls = TopCounter(max_funccalls)
+        # Number of names in the function calls output, None for all
+        self.funccall_top = None
+        # Depth of the directories output (see DirectoryTree), and number of the directories with most warnings
+        self.rollup_depth = None
+        self.top_dirs = None
         self.__funcdecls = set()
         self.__funcdefs = set()
         self.__bar_max = 80
         self.__output = None
         self.__funcinfo_available = settings.funcinfo_available
+        self.__settings = settings
+
+    def __getstate__(self):
+        # Partial reports are pickled for workers and the cache, without the settings
+        state = self.__dict__.copy()
+        state["_Report__settings"] = None
+        state["_Report__source_lines"] = None
+        return state
 
-    def increase_file_count(self, extension):
+    def attach(self, settings):
+        """Set the settings again after unpickling, for output."""
+        self.__settings = settings
+
+    def file_id(self, filename):
+        file_id = self.__file_ids.get(filename)
+        if file_id is None:
+            file_id = self.__file_ids[filename] = len(self.__filenames)
+            self.__filenames.append(filename)
+        return file_id
+
+    def increase_file_count(self, path):
+        extension = os.path.splitext(path)[1]
         self.__file_count_by_extension[extension] = self.__file_count_by_extension.setdefault(extension, 0) + 1
+        self.__dir_totals(os.path.dirname(path)).files += 1
+
+    def __dir_totals(self, directory):
+        totals = self.__totals_by_dir.get(directory)
+        if totals is None:
+            totals = self.__totals_by_dir[directory] = DirectoryTotals()
+        return totals
+
+    def __file_dir_totals(self, file_id):
+        """Return the DirectoryTotals of the directory of the file, hits of a file come together."""
+        if self.__last_dir_totals[0] != file_id:
+            self.__last_dir_totals = (file_id, self.__dir_totals(os.path.dirname(self.__filenames[file_id])))
+        return self.__last_dir_totals[1]
+
+    def set_encoding(self, filename, encoding):
+        self.__encoding_by_filename[filename] = encoding
+
+    def encoding_of(self, filename):
+        return self.__encoding_by_filename.get(filename)
 
-    def increase_keyword_count(self, cateogry):
+    def increase_keyword_count(self, cateogry, file_id=None):
         self.__keyword_count_by_category[cateogry] += 1
+        if file_id is not None:
+            key = (file_id, cateogry)
+            self.__keyword_counts_by_file[key] = self.__keyword_counts_by_file.get(key, 0) + 1
+            counts = self.__file_dir_totals(file_id).counts
+            counts[cateogry] = counts.get(cateogry, 0) + 1
 
     def increase_funccall_count(self, name):
-        self.__funccall_count_by_name[name] = self.__funccall_count_by_name.setdefault(name, 0) + 1
+        self.__funccalls.add(name)
 
     def add_funcdecl(self, name):
         self.__funcdecls.add(name)
@@ -272,14 +1694,96 @@ class Report(object):
         self.__funcdefs.add(name)
 
     def add_warning(self, cateogry, warning):
-        self.__warnings_by_category[cateogry].append(warning)
+        self.__warning_count_by_category[cateogry] += 1
+        key = (warning.file_id, cateogry)
+        self.__warning_counts_by_file[key] = self.__warning_counts_by_file.get(key, 0) + 1
+        counts = self.__file_dir_totals(warning.file_id).warnings
+        counts[cateogry] = counts.get(cateogry, 0) + 1
+        warnings = self.__warnings_by_category[cateogry]
+        if self.__max_warnings is None or len(warnings) < self.__max_warnings:
+            warnings.append(warning)
+
+    def warning_count(self, category):
+        return self.__warning_count_by_category[category]
+
+    def total_warning_count(self):
+        return sum(self.__warning_count_by_category.values())
+
+    def warning_text(self, warning):
+        """Return the line of the warning, read from the file again if it wasn't kept."""
+        if warning.text is not None:
+            return warning.text
+        if self.__source_lines is None:
+            self.__source_lines = {}
+            for warnings in self.__warnings_by_category.values():
+                for w in warnings:
+                    if w.text is None:
+                        self.__source_lines.setdefault(w.file_id, set()).add(w.lineno)
+        lines = self.__source_lines.get(warning.file_id)
+        if type(lines) is set:
+            lines = self.__source_lines[warning.file_id] = self.__read_lines(self.__filenames[warning.file_id], lines)
+        return lines.get(warning.lineno, "") if lines else ""
+
+    def __read_lines(self, filename, linenos):
+        """Return {line number: line} of the file, decoding it only up to the last line number."""
+        encoding = self.__encoding_by_filename.get(filename)
+        last = max(linenos)
+        lines = {}
+        try:
+            with open(filename, mode="rb") as f:
+                if encoding in (None, "ascii"):
+                    stream = DecodedLines(f)
+                else:
+                    stream = io.TextIOWrapper(f, encoding, "replace", None)
+                for lineno, line in enumerate(stream, 1):
+                    if lineno in linenos:
+                        lines[lineno] = line.rstrip("\n")
+                    if last <= lineno:
+                        break
+        except (OSError, UnicodeError):
+            pass
+        return lines
+
+    def merge(self, other):
+        self.non_diff_line_count += other.non_diff_line_count
+        self.pure_added_line_count += other.pure_added_line_count
+        self.pure_deleted_line_count += other.pure_deleted_line_count
+        self.replace_added_line_count += other.replace_added_line_count
+        self.replace_deleted_line_count += other.replace_deleted_line_count
+        self.added_block_count += other.added_block_count
+        self.deleted_block_count += other.deleted_block_count
+        self.replaced_block_count += other.replaced_block_count
+        for extension, count in other.__file_count_by_extension.items():
+            self.__file_count_by_extension[extension] = self.__file_count_by_extension.get(extension, 0) + count
+        for directory, totals in other.__totals_by_dir.items():
+            self.__dir_totals(directory).add(totals)
+        self.__encoding_by_filename.update(other.__encoding_by_filename)
+        for category, count in other.__keyword_count_by_category.items():
+            self.__keyword_count_by_category[category] += count
+        # The warnings of other are taken over
+        file_ids = [self.file_id(filename) for filename in other.__filenames]
+        for category, warnings in other.__warnings_by_category.items():
+            self.__warning_count_by_category[category] += other.__warning_count_by_category[category]
+            own_warnings = self.__warnings_by_category[category]
+            if self.__max_warnings is not None:
+                warnings = warnings[:max(0, self.__max_warnings - len(own_warnings))]
+            for warning in warnings:
+                warning.file_id = file_ids[warning.file_id]
+            own_warnings.extend(warnings)
+        for own_counts, counts in ((self.__keyword_counts_by_file, other.__keyword_counts_by_file), (self.__warning_counts_by_file, other.__warning_counts_by_file)):
+            for (file_id, category), count in counts.items():
+                key = (file_ids[file_id], category)
+                own_counts[key] = own_counts.get(key, 0) + count
+        self.__funccalls.merge(other.__funccalls)
+        self.__funcdecls.update(other.__funcdecls)
+        self.__funcdefs.update(other.__funcdefs)
 
-    def output(self, output):
+    def output(self, output, details=True):
         self.__output = output
         if self.__output.isatty():
             self.__output.print("-" * 60)
         self.__output.print()
-        if self.output_warning_details():
+        if details and self.output_warning_details():
             self.__output.print("-" * 60)
             self.__output.print()
         self.output_summary()
@@ -288,30 +1792,38 @@ class Report(object):
             self.output_funcdefs()
             self.output_funccalls()
         self.output_warnings()
+        if self.rollup_depth is not None or self.top_dirs:
+            self.output_directories()
 
-    def output_warning_details(self):
+    def output_warning_details(self, output=None):
+        self.__output = output or self.__output
         total_count = 0
         for category in self.__warnings_by_category:
             warnings = self.__warnings_by_category[category]
-            count = len(warnings)
+            count = self.__warning_count_by_category[category]
             if 0 < count:
-                self.__output.print("# {0} ({1})".format(category, count), "cyan")
+                if len(warnings) < count:
+                    self.__output.print("# {0} ({1}, first {2} shown)".format(category, count, len(warnings)), "cyan")
+                else:
+                    self.__output.print("# {0} ({1})".format(category, count), "cyan")
                 self.__output.print()
                 for warning in warnings:
-                    self.__output.print("{0}:{1}  ".format(warning.filename, warning.lineno), "*")
+                    self.__output.print("{0}:{1}  ".format(self.__filenames[warning.file_id], warning.lineno), "*")
 
+                    text = self.warning_text(warning).replace("\t", " ")
                     self.__output.print("```")
-                    self.__output.print(warning.text[:warning.start], "", False)
-                    self.__output.print(warning.text[warning.start:warning.end], "*red", False)
-                    self.__output.print(warning.text[warning.end:])
+                    self.__output.print(text[:warning.start], "", False)
+                    self.__output.print(text[warning.start:warning.end], "*red", False)
+                    self.__output.print(text[warning.end:])
 
-                    width_start = strlen_on_screen(warning.text[:warning.start])
-                    width_match = strlen_on_screen(warning.text[warning.start:warning.end])
+                    width_start = strlen_on_screen(text[:warning.start])
+                    width_match = strlen_on_screen(text[warning.start:warning.end])
                     self.__output.print(" " * width_start + "^" + "~" * (width_match - 1), "*red")
                     self.__output.print("```")
-                    if warning.pattern.message:
-                        match_word = warning.text[warning.start:warning.end]
-                        self.__output.print("* " + warning.pattern.message.replace("{0}", match_word))
+                    message = self.__settings.warning.pattern(warning.pattern_id).message
+                    if message:
+                        match_word = text[warning.start:warning.end]
+                        self.__output.print("* " + message.replace("{0}", match_word))
                     self.__output.print()
             total_count += count
         return bool(total_count)
@@ -380,11 +1892,9 @@ class Report(object):
         self.__output.print("# Function calls", "cyan")
         self.__output.print()
         self.__output.isatty() or self.__output.print("```")
-        sorted_list = list(self.__funccall_count_by_name.items())
-        sorted_list.sort(key = itemgetter(0), reverse = False)
-        sorted_list.sort(key = itemgetter(1), reverse = True)
+        sorted_list = self.__funccalls.top(self.funccall_top)
         if 0 < len(sorted_list):
-            max_width = strlen_on_screen(max(self.__funccall_count_by_name, key = lambda k : len(k)))
+            max_width = strlen_on_screen(max((name for name, count in sorted_list), key = lambda k : len(k)))
             max_width = min(30, max_width)
             max_count = max(sorted_list, key = lambda t: t[1])[1]
             bar_scale = 1 / max(1, math.ceil(max_count / self.__bar_max))
@@ -393,6 +1903,9 @@ class Report(object):
                     name, " " * (max_width - strlen_on_screen(name)),
                     count,
                     "#" * math.ceil(count * bar_scale)))
+            if not self.__funccalls.exact:
+                self.__output.print("  (Approximate: {0} of the names kept, a count may be over by up to {1})".format(
+                    len(self.__funccalls), self.__funccalls.lowest()))
         self.__output.isatty() or self.__output.print("```")
         self.__output.print()
         return bool(len(sorted_list))
@@ -402,9 +1915,8 @@ class Report(object):
         self.__output.print()
         self.__output.isatty() or self.__output.print("```")
         max_width = strlen_on_screen(max(self.__warnings_by_category, key = lambda k : len(k)))
-        for category in self.__warnings_by_category:
-            warnings = self.__warnings_by_category[category]
-            count = len(warnings)
+        for category in self.__warning_count_by_category:
+            count = self.__warning_count_by_category[category]
             self.__output.print(
                 "  * {0}{1} - {2:3} {3}".format(category, " " * (max_width - strlen_on_screen(category)), count, "#" * count),
                 "green" if (count == 0) else "red")
@@ -412,7 +1924,98 @@ class Report(object):
         self.__output.print()
         return True
 
+    def output_directories(self):
+        tree = self.directory_tree()
+        if self.rollup_depth is not None:
+            self.__output.print("# Directories (depth {0})".format(self.rollup_depth), "cyan")
+            self.__output.print()
+            self.__output.isatty() or self.__output.print("```")
+            self.__output_directory_rows(tree.rollup(self.rollup_depth))
+            self.__output.isatty() or self.__output.print("```")
+            self.__output.print()
+        if self.top_dirs:
+            self.__output.print("# Top directories", "cyan")
+            self.__output.print()
+            self.__output.isatty() or self.__output.print("```")
+            self.__output_directory_rows(tree.top(self.top_dirs, self.rollup_depth))
+            self.__output.isatty() or self.__output.print("```")
+            self.__output.print()
+
+    def __output_directory_rows(self, rows):
+        max_width = min(40, max([strlen_on_screen(path) for path, totals in rows] or [0]))
+        for path, totals in rows:
+            self.__output.print("  * {0}{1} - {2:5} files {3:5} warnings {4}".format(
+                path, " " * (max_width - strlen_on_screen(path)), totals.files, totals.warning_count(),
+                ", ".join("{0}: {1}".format(category, count) for category, count in totals.warnings.items() if count)),
+                "green" if totals.warning_count() == 0 else "red")
+
+    def directory_tree(self, cwd=None):
+        """Return the DirectoryTree of the files, with paths relative to cwd (default: current directory)."""
+        cwd = cwd or os.getcwd()
+        tree = DirectoryTree()
+        for directory, totals in self.__totals_by_dir.items():
+            tree.add(relative_path(directory, cwd), totals)
+        return tree
+
+    def warning_data(self):
+        """Yield a dict for each warning, with 1-based line and column numbers."""
+        for category, warnings in self.__warnings_by_category.items():
+            for warning in warnings:
+                text = self.warning_text(warning)
+                message = self.__settings.warning.pattern(warning.pattern_id).message
+                data = OrderedDict()
+                data["category"] = category
+                data["file"] = self.__filenames[warning.file_id]
+                data["line"] = warning.lineno
+                data["column"] = warning.start + 1
+                data["end_column"] = warning.end + 1
+                data["text"] = text
+                data["match"] = text[warning.start:warning.end]
+                data["message"] = message and message.replace("{0}", data["match"])
+                yield data
+
+    def data(self):
+        """Return the summary, counts and function information as a dict."""
+        summary = OrderedDict()
+        summary["files"] = OrderedDict((ext[1:], self.__file_count_by_extension[ext]) for ext in sorted(self.__file_count_by_extension))
+        summary["blocks"] = OrderedDict((
+            ("add", self.added_block_count),
+            ("delete", self.deleted_block_count),
+            ("replace", self.replaced_block_count)))
+        summary["lines"] = OrderedDict((
+            ("add", self.pure_added_line_count + self.replace_added_line_count),
+            ("pure_add", self.pure_added_line_count),
+            ("replace_add", self.replace_added_line_count),
+            ("delete", self.pure_deleted_line_count + self.replace_deleted_line_count),
+            ("pure_delete", self.pure_deleted_line_count),
+            ("replace_delete", self.replace_deleted_line_count),
+            ("non_diff", self.non_diff_line_count)))
+        data = OrderedDict()
+        data["summary"] = summary
+        data["counts"] = OrderedDict(self.__keyword_count_by_category)
+        if self.__funcinfo_available:
+            data["funcdefs"] = sorted(self.__funcdefs)
+            sorted_list = self.__funccalls.top(self.funccall_top)
+            data["funccalls"] = OrderedDict(sorted_list)
+            if not self.__funccalls.exact:
+                data["funccall_errors"] = OrderedDict((name, self.__funccalls.error(name)) for name, count in sorted_list)
+        data["warning_counts"] = OrderedDict(self.__warning_count_by_category)
+        if self.rollup_depth is not None or self.top_dirs:
+            tree = self.directory_tree()
+            if self.rollup_depth is not None:
+                data["directories"] = [totals.data(path) for path, totals in tree.rollup(self.rollup_depth)]
+            if self.top_dirs:
+                data["top_directories"] = [totals.data(path) for path, totals in tree.top(self.top_dirs, self.rollup_depth)]
+        return data
+
+    def file_counts(self):
+        """Yield (file name, "counter" or "warning", category, count) for each file and category with a hit."""
+        for kind, counts in (("counter", self.__keyword_counts_by_file), ("warning", self.__warning_counts_by_file)):
+            for (file_id, category), count in counts.items():
+                yield self.__filenames[file_id], kind, category, count
+
     def write_log(self, log_dir):
+        import datetime
         now = datetime.datetime.now()
         log_path = os.path.join(log_dir, "{0:04}W{1:02}".format(now.year, now.isocalendar()[1]) + ".log")
         with open(log_path, "a") as f:
@@ -423,9 +2026,8 @@ class Report(object):
             summary["-"] = self.pure_deleted_line_count + self.replace_deleted_line_count
 
             warning_counts = OrderedDict()
-            for category in self.__warnings_by_category:
-                warnings = self.__warnings_by_category[category]
-                warning_counts[category] = len(warnings)
+            for category in self.__warning_count_by_category:
+                warning_counts[category] = self.__warning_count_by_category[category]
 
             data = OrderedDict()
             data["summary"] = summary
@@ -436,8 +2038,513 @@ class Report(object):
                 os.getcwd(),
                 json.dumps(data, separators=(',', ':'), ensure_ascii=False)))
 
+class DirectoryTotals(object):
+    """Numbers of files, warnings and counter hits of a directory."""
+    __slots__ = ("files", "warnings", "counts")
+
+    def __init__(self):
+        self.files = 0
+        self.warnings = {}
+        self.counts = {}
+
+    def add(self, other):
+        self.files += other.files
+        for own, counts in ((self.warnings, other.warnings), (self.counts, other.counts)):
+            for category, count in counts.items():
+                own[category] = own.get(category, 0) + count
+
+    def warning_count(self):
+        return sum(self.warnings.values())
+
+    def data(self, path):
+        data = OrderedDict()
+        data["path"] = path
+        data["files"] = self.files
+        data["warnings"] = OrderedDict(sorted(self.warnings.items()))
+        data["counts"] = OrderedDict(sorted(self.counts.items()))
+        return data
+
+class DirectoryTree(object):
+    """Prefix tree of directories, holding the totals of the files directly in each one.
+
+    The totals of a directory with its subdirectories are summed up as the
+    tree is walked, so its size is by the number of directories, not files.
+    """
+    def __init__(self):
+        # [totals of the files directly in it, {name: child node}]
+        self.__root = [DirectoryTotals(), {}]
+
+    def add(self, directory, totals):
+        """Add the DirectoryTotals of the files directly in the directory (relative or absolute path)."""
+        node = self.__root
+        for name in self.__split(directory):
+            child = node[1].get(name)
+            if child is None:
+                child = node[1][name] = [DirectoryTotals(), {}]
+            node = child
+        node[0].add(totals)
+
+    @staticmethod
+    def __split(directory):
+        names = []
+        while directory and directory not in (os.curdir, os.sep):
+            directory, name = os.path.split(directory)
+            names.append(name)
+        if directory == os.sep:
+            names.append(os.sep)
+        return reversed(names)
+
+    def rollup(self, depth):
+        """Return [(path, totals)] of the directories down to the depth (1 or more), with all files under each one, in path order."""
+        rows = [(path, totals) for path, level, own, totals in self.__walk(depth) if 0 < level]
+        rows.sort(key=lambda row: row[0].split(os.sep))
+        return rows
+
+    def top(self, count, depth=None):
+        """Return [(path, totals)] of the count directories with most warnings.
+
+        With depth the files under a directory at the depth count for it, otherwise only the files directly in it.
+        """
+        rows = [(path or os.curdir, totals if level == depth else own)
+            for path, level, own, totals in self.__walk(depth) if own.warnings or level == depth]
+        rows.sort(key=lambda row: (-row[1].warning_count(), row[0]))
+        return rows[:count]
+
+    def __walk(self, depth):
+        """Return [(path, level, own totals, totals with subdirectories)] of the directories down to the depth."""
+        rows = []
+        def walk(node, path, level):
+            totals = DirectoryTotals()
+            totals.add(node[0])
+            for name, child in node[1].items():
+                totals.add(walk(child, os.path.join(path, name), level + 1))
+            if depth is None or level <= depth:
+                rows.append((path, level, node[0], totals))
+            return totals
+        walk(self.__root, "", 0)
+        return rows
+
 class Warning(object):
-    pass
+    """A hit of a warning pattern, the line is only kept if it can't be read again later."""
+    __slots__ = ("file_id", "lineno", "start", "end", "pattern_id", "text")
+
+    def __init__(self, file_id, lineno, start, end, pattern_id, text=None):
+        self.file_id = file_id
+        self.lineno = lineno
+        self.start = start
+        self.end = end
+        self.pattern_id = pattern_id
+        self.text = text
+
+    def __getstate__(self):
+        return (self.file_id, self.lineno, self.start, self.end, self.pattern_id, self.text)
+
+    def __setstate__(self, state):
+        self.file_id, self.lineno, self.start, self.end, self.pattern_id, self.text = state
+
+class TopCounter(object):
+    """Counts of names, bounded to capacity names by the Space-Saving algorithm.
+
+    The counts are exact until more than capacity names are seen. Then a new
+    name takes the place and the count of the lowest one, which is kept as
+    its error: a count is never below the real one and at most the error
+    above it, and a name counted more than total / capacity times is always
+    kept. Counters of parallel runs are merged with the same guarantees.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.total = 0
+        self.exact = True
+        self.__counts = {}
+        self.__errors = {}
+        # Min-heap of (count, name), its counts are updated lazily
+        self.__heap = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_TopCounter__heap"] = None
+        return state
+
+    def __len__(self):
+        return len(self.__counts)
+
+    def add(self, name, count=1):
+        self.total += count
+        counts = self.__counts
+        if name in counts:
+            counts[name] += count
+        elif self.capacity is None or len(counts) < self.capacity:
+            counts[name] = count
+        else:
+            low_name, low = self.__pop_lowest()
+            del counts[low_name]
+            self.__errors.pop(low_name, None)
+            counts[name] = low + count
+            self.__errors[name] = low
+            heapq.heappush(self.__heap, (low + count, name))
+            self.exact = False
+
+    def __pop_lowest(self):
+        counts = self.__counts
+        if self.__heap is None:
+            self.__heap = [(count, name) for name, count in counts.items()]
+            heapq.heapify(self.__heap)
+        heap = self.__heap
+        while True:
+            count, name = heap[0]
+            if counts[name] == count:
+                heapq.heappop(heap)
+                return name, count
+            heapq.heapreplace(heap, (counts[name], name))
+
+    def lowest(self):
+        """Return the count no name left out can exceed, 0 while the counts are exact."""
+        return 0 if self.exact or not self.__counts else min(self.__counts.values())
+
+    def error(self, name):
+        """Return how much the count of the name may be over the real one."""
+        return self.__errors.get(name, 0)
+
+    def count(self, name):
+        return self.__counts.get(name, 0)
+
+    def top(self, k=None):
+        """Return up to k (name, count) pairs, the highest counts first."""
+        items = sorted(self.__counts.items(), key=itemgetter(0))
+        items.sort(key=itemgetter(1), reverse=True)
+        return items if k is None else items[:k]
+
+    def merge(self, other):
+        if other.exact:
+            # E.g. the counter of a file, its names are counted as if they were added here
+            for name, count in other.__counts.items():
+                self.add(name, count)
+            return
+        self.total += other.total
+        counts = self.__counts
+        # A name missing in a side that has dropped names may have had up to its lowest count there
+        low = self.lowest()
+        other_low = other.lowest()
+        merged = {}
+        errors = {}
+        for name in itertools.chain(counts, (name for name in other.__counts if name not in counts)):
+            count = counts.get(name)
+            error = self.__errors.get(name, 0) if count is not None else low
+            other_count = other.__counts.get(name)
+            other_error = other.__errors.get(name, 0) if other_count is not None else other_low
+            merged[name] = (low if count is None else count) + (other_low if other_count is None else other_count)
+            if error or other_error:
+                errors[name] = error + other_error
+        self.exact = False
+        if self.capacity is not None and self.capacity < len(merged):
+            merged = dict(heapq.nlargest(self.capacity, merged.items(), key=itemgetter(1)))
+            errors = dict((name, error) for name, error in errors.items() if name in merged)
+        self.__counts = merged
+        self.__errors = errors
+        self.__heap = None
+
+class ResultCache(object):
+    """On-disk store of per-file partial reports.
+
+    Entries are keyed by the file path and content, the settings, the
+    options of the Inspector and this script itself, so a hit can be merged
+    into the report as it is. The
+    least recently used entries are evicted on close() to keep the total
+    size under max_size bytes.
+    """
+
+    # Number of put() committed together, the workers can't read the cache while a commit is written
+    commit_interval = 64
+
+    def __init__(self, path, settings, max_size, options=None):
+        self.__salt = script_hash() + settings.hash + repr(sorted((options or {}).items()))
+        self.path = path
+        self.__max_size = max_size
+        self.__used_keys = []
+        self.__put_count = 0
+        import sqlite3
+        self.__db = sqlite3.connect(path)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, data BLOB, size INTEGER, used REAL)")
+
+    def key(self, path):
+        h = hashlib.sha1(self.__salt.encode("utf-8"))
+        h.update(path.encode("utf-8", "surrogateescape"))
+        with open(path, mode="rb") as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def get(self, key):
+        row = self.__db.execute("SELECT data FROM results WHERE key = ?", (key,)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def touch(self, key):
+        """Mark the entry as used, for the eviction."""
+        self.__used_keys.append(key)
+
+    def put(self, key, report):
+        data = pickle.dumps(report, pickle.HIGHEST_PROTOCOL)
+        self.__db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, data, len(data), time.time()))
+        self.__put_count += 1
+        if self.commit_interval <= self.__put_count:
+            self.__db.commit()
+            self.__put_count = 0
+
+    def close(self):
+        if self.__max_size is None:
+            # Opened by a worker only to read
+            self.__db.close()
+            return
+        now = time.time()
+        self.__db.executemany("UPDATE results SET used = ? WHERE key = ?", ((now, key) for key in self.__used_keys))
+        self.__db.execute("""
+            DELETE FROM results WHERE key IN (
+                SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY used DESC, key) AS total FROM results)
+                WHERE ? < total)""", (self.__max_size,))
+        self.__db.commit()
+        self.__db.close()
+
+class MemoryCache(object):
+    """Per-file partial reports kept by the server, valid while the file's mtime and size are unchanged.
+
+    It has the interface of ResultCache, but can only be looked up in the
+    process that holds it. The least recently used entries are dropped to keep
+    the total size under max_size bytes.
+    """
+    path = None
+
+    def __init__(self, max_size=None):
+        self.__entries = OrderedDict()
+        self.__max_size = max_size
+        self.__size = 0
+        # Set by the Server to the inspection options, reports made with other options are other entries
+        self.namespace = None
+
+    def key(self, path):
+        stat = os.stat(path)
+        return ((self.namespace, path), stat.st_mtime_ns, stat.st_size)
+
+    def get(self, key):
+        entry = self.__entries.get(key[0])
+        if not entry or entry[0] != key:
+            return None
+        self.__entries.move_to_end(key[0])
+        # Merging changes the report, so each hit gets its own copy
+        return pickle.loads(entry[1])
+
+    def touch(self, key):
+        pass
+
+    def put(self, key, report):
+        data = pickle.dumps(report, pickle.HIGHEST_PROTOCOL)
+        old = self.__entries.pop(key[0], None)
+        if old:
+            self.__size -= len(old[1])
+        self.__entries[key[0]] = (key, data)
+        self.__size += len(data)
+        while self.__max_size is not None and self.__max_size < self.__size:
+            self.__size -= len(self.__entries.popitem(last=False)[1][1])
+
+    def clear(self):
+        self.__entries.clear()
+        self.__size = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def close(self):
+        pass
+
+class MetricsStore(object):
+    """SQLite store of the counts of each run and each file, for "pokalint.py stats".
+
+    A period of a trend is represented by its last run, so the runs compared
+    should be made with the same arguments (e.g. a nightly "-r .").
+    """
+    # SQL of the period of a run, the week is the ISO week as in the name of the weekly log
+    PERIODS = OrderedDict((
+        ("day", "strftime('%Y-%m-%d', time)"),
+        ("week", "printf('%sW%02d', strftime('%Y', time, '-3 days', 'weekday 4'), (strftime('%j', time, '-3 days', 'weekday 4') - 1) / 7 + 1)"),
+        ("month", "strftime('%Y-%m', time)")))
+
+    def __init__(self, path):
+        import sqlite3
+        self.__db = sqlite3.connect(path)
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, time TEXT, cwd TEXT, files INTEGER, added INTEGER, deleted INTEGER);
+            CREATE INDEX IF NOT EXISTS runs_cwd_time ON runs (cwd, time);
+            CREATE TABLE IF NOT EXISTS totals (run INTEGER, kind TEXT, category TEXT, count INTEGER);
+            CREATE INDEX IF NOT EXISTS totals_run ON totals (run, category);
+            CREATE TABLE IF NOT EXISTS file_totals (run INTEGER, dir TEXT, file TEXT, kind TEXT, category TEXT, count INTEGER);
+            CREATE INDEX IF NOT EXISTS file_totals_run ON file_totals (run, category);""")
+
+    def close(self):
+        self.__db.close()
+
+    def record(self, report, cwd, time=None):
+        """Add the counts of the report as a run in cwd, made at time (an ISO format string, default: now)."""
+        if time is None:
+            import datetime
+            time = datetime.datetime.now().isoformat(timespec="seconds")
+        data = report.data()
+        with self.__db:
+            run = self.__db.execute("INSERT INTO runs (time, cwd, files, added, deleted) VALUES (?, ?, ?, ?, ?)", (
+                time, cwd, sum(data["summary"]["files"].values()), data["summary"]["lines"]["add"], data["summary"]["lines"]["delete"])).lastrowid
+            self.__db.executemany("INSERT INTO totals VALUES (?, ?, ?, ?)", itertools.chain(
+                ((run, "counter", category, count) for category, count in data["counts"].items()),
+                ((run, "warning", category, count) for category, count in data["warning_counts"].items())))
+            rows = []
+            for filename, kind, category, count in report.file_counts():
+                filename = relative_path(filename, cwd)
+                rows.append((run, os.path.dirname(filename) or ".", filename, kind, category, count))
+            self.__db.executemany("INSERT INTO file_totals VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return run
+
+    def __last_runs(self, period):
+        # Last run of each period
+        return """
+            WITH last AS (
+                SELECT {0} AS period, MAX(id) AS run, COUNT(*) AS runs FROM runs
+                WHERE cwd = :cwd AND :since <= time GROUP BY period)""".format(self.PERIODS[period])
+
+    def trend(self, cwd, since="", period="week", category=None):
+        """Return [(period, runs, category, count)] of the warnings (or the category) by the last run of each period."""
+        return self.__db.execute(self.__last_runs(period) + """
+            SELECT period, runs, category, count FROM last JOIN totals ON totals.run = last.run
+            WHERE (:category IS NULL AND kind = 'warning') OR category = :category
+            ORDER BY period, totals.rowid""", {"cwd": cwd, "since": since, "category": category}).fetchall()
+
+    def dir_trend(self, cwd, since="", period="week", category=None):
+        """Return [(period, directory, count)] of the warnings (or the category) by the last run of each period."""
+        return self.__db.execute(self.__last_runs(period) + """
+            SELECT period, dir, SUM(count) FROM last JOIN file_totals ON file_totals.run = last.run
+            WHERE (:category IS NULL AND kind = 'warning') OR category = :category
+            GROUP BY period, dir ORDER BY period, dir""", {"cwd": cwd, "since": since, "category": category}).fetchall()
+
+    def top_files(self, cwd, category=None, count=10):
+        """Return [(file, count)] of the files with the most warnings (or hits of the category) in the last run."""
+        return self.__db.execute("""
+            SELECT file, SUM(count) AS total FROM file_totals
+            WHERE run = (SELECT MAX(id) FROM runs WHERE cwd = :cwd)
+                AND ((:category IS NULL AND kind = 'warning') OR category = :category)
+            GROUP BY file ORDER BY total DESC, file LIMIT :limit""", {"cwd": cwd, "category": category, "limit": count}).fetchall()
+
+class JsonlWriter(object):
+    """Writes one JSON object per line: warnings as they are found, then the other results."""
+    def __init__(self, file, settings):
+        self._file = file
+
+    def write_warnings(self, report):
+        for data in report.warning_data():
+            self._write_record("warning", data)
+        self._file.flush()
+
+    def finish(self, report):
+        for record_type, value in report.data().items():
+            self._write_record(record_type, {record_type: value})
+
+    def abort(self, message):
+        """End the output of a run that failed with the error message."""
+        self._write_record("error", {"error": message})
+
+    def _write_record(self, record_type, data):
+        record = OrderedDict(type=record_type)
+        record.update(data)
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+class JsonWriter(JsonlWriter):
+    """Writes a single JSON document, the warnings array is streamed before the other results.
+
+    Nothing is written until the first warning or the end, which is also
+    written by abort() so that a failed run still makes a whole document.
+    """
+    def __init__(self, file, settings):
+        super().__init__(file, settings)
+        # Number of results written, None before the beginning
+        self._count = None
+        self._ended = False
+
+    def write_warnings(self, report):
+        for data in report.warning_data():
+            self._write_result(data)
+        self._file.flush()
+
+    def finish(self, report):
+        data = report.data()
+        if self._count is None:
+            self._start()
+        self._ended = True
+        self._end(data)
+
+    def abort(self, message):
+        if not self._ended:
+            if self._count is None:
+                self._start()
+            self._ended = True
+            self._end_error(message)
+
+    def _start(self):
+        self._count = 0
+        self._begin()
+
+    def _begin(self):
+        self._file.write('{"warnings":[')
+
+    def _write_result(self, data):
+        if self._count is None:
+            self._start()
+        self._file.write((",\n" if self._count else "\n") + json.dumps(data, ensure_ascii=False))
+        self._count += 1
+
+    def _end(self, data):
+        self._file.write("\n]")
+        for key, value in data.items():
+            self._file.write(",\n{0}:{1}".format(json.dumps(key), json.dumps(value, ensure_ascii=False)))
+        self._file.write("}\n")
+
+    def _end_error(self, message):
+        self._end(OrderedDict(error=message))
+
+class SarifWriter(JsonWriter):
+    """Writes a SARIF 2.1.0 log, streaming the results. The other results go to the run properties."""
+    def __init__(self, file, settings):
+        self.__categories = list(settings.warning.names())
+        super().__init__(file, settings)
+
+    def _begin(self):
+        driver = OrderedDict()
+        driver["name"] = "pokalint"
+        driver["rules"] = [{"id": category} for category in self.__categories]
+        self._file.write('{{"version":"2.1.0","$schema":"https://json.schemastore.org/sarif-2.1.0.json","runs":[{{"tool":{{"driver":{0}}},"results":['.format(
+            json.dumps(driver, ensure_ascii=False)))
+
+    def _write_result(self, data):
+        region = OrderedDict()
+        region["startLine"] = data["line"]
+        region["startColumn"] = data["column"]
+        region["endColumn"] = data["end_column"]
+        region["snippet"] = {"text": data["text"]}
+        import pathlib
+        filename = data["file"]
+        uri = pathlib.Path(filename).as_uri() if os.path.isabs(filename) else filename.replace(os.sep, "/")
+        result = OrderedDict()
+        result["ruleId"] = data["category"]
+        result["ruleIndex"] = self.__categories.index(data["category"])
+        result["level"] = "warning"
+        result["message"] = {"text": data["message"] or "'{0}' is detected.".format(data["match"])}
+        result["locations"] = [{"physicalLocation": {"artifactLocation": {"uri": uri}, "region": region}}]
+        super()._write_result(result)
+
+    def _end(self, data):
+        self._file.write('\n],"properties":{0}}}]}}\n'.format(json.dumps(data, ensure_ascii=False)))
+
+    def _end_error(self, message):
+        invocation = OrderedDict()
+        invocation["executionSuccessful"] = False
+        invocation["toolExecutionNotifications"] = [{"level": "error", "message": {"text": message}}]
+        self._file.write('\n],"invocations":[{0}]}}]}}\n'.format(json.dumps(invocation, ensure_ascii=False)))
+
+WRITERS = {"jsonl": JsonlWriter, "json": JsonWriter, "sarif": SarifWriter}
 
 def print_banner(output):
     output.print()
@@ -449,56 +2556,781 @@ def print_banner(output):
     output.print(" #        ####   #    #  #    #  ######   #   #    #    #  ")
     output.print()
 
-def travarse_files(paths, recursive, handler):
+class GitIgnore(object):
+    """The patterns of a .gitignore file, for paths relative to its directory."""
+    def __init__(self, lines):
+        self.__rules = []
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            line = re.sub(r"(?<!\\)\s+$", "", line)
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if line:
+                self.__rules.append((re.compile(self.__translate(line)), negate, dir_only))
+
+    @staticmethod
+    def load(path):
+        with open(path, mode="rb") as f:
+            return GitIgnore(split_lines(decode_bytes(f.read())[0]))
+
+    def match(self, path, is_dir):
+        """Return True if ignored, False if included again by a negation, None if no pattern matches."""
+        result = None
+        for regex, negate, dir_only in self.__rules:
+            if (is_dir or not dir_only) and regex.match(path):
+                result = not negate
+        return result
+
+    @staticmethod
+    def __translate(pattern):
+        # A pattern with a slash is relative to the .gitignore, otherwise it matches at any depth
+        regex = "" if "/" in pattern else "(?:.*/)?"
+        pattern = pattern.lstrip("/")
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if pattern.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+                continue
+            if pattern.startswith("**", i):
+                regex += ".*"
+                i += 2
+                continue
+            if c == "*":
+                regex += "[^/]*"
+            elif c == "?":
+                regex += "[^/]"
+            elif c == "[" and "]" in pattern[i + 2:]:
+                end = pattern.index("]", i + 2)
+                regex += "[" + pattern[i + 1:end].replace("!", "^", 1).replace("\\", "\\\\") + "]"
+                i = end
+            elif c == "\\" and i + 1 < len(pattern):
+                i += 1
+                regex += re.escape(pattern[i])
+            else:
+                regex += re.escape(c)
+            i += 1
+        return regex + "$"
+
+def walk_files(paths, recursive, excludes=(), gitignore=True):
+    """Yield the file paths given by paths, which may contain wildcards.
+
+    With recursive, directories are walked with os.scandir, pruning the ".git"
+    directory, entries matching one of the excludes (glob patterns for the
+    name or the path relative to the given directory) and, if gitignore,
+    entries ignored by .gitignore files found in the walked directories.
+    """
     for path in paths:
         if "*" in path:
-            travarse_files(glob.glob(path), recursive, handler)
+            yield from walk_files(glob.glob(path), recursive, excludes, gitignore)
         elif os.path.isfile(path) or not os.path.exists(path):
-            handler(path)
+            yield path
+        elif os.path.isdir(path) and recursive:
+            yield from walk_directory(path, excludes, gitignore)
+
+def walk_directory(root, excludes=(), gitignore=True):
+    stack = [(root, "", ())]
+    while stack:
+        directory, relative_dir, ignores = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key = lambda e: e.name)
+        except OSError:
+            continue
+        if gitignore and any(entry.name == ".gitignore" for entry in entries):
+            try:
+                ignores = ignores + ((len(relative_dir), GitIgnore.load(os.path.join(directory, ".gitignore"))),)
+            except OSError:
+                pass
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir and entry.name == ".git":
+                continue
+            relative_path = relative_dir + entry.name
+            if any(fnmatch.fnmatch(entry.name, e) or fnmatch.fnmatch(relative_path, e) for e in excludes):
+                continue
+            ignored = None
+            for base_length, ignore in ignores:
+                result = ignore.match(relative_path[base_length:], is_dir)
+                if result is not None:
+                    ignored = result
+            if ignored:
+                continue
+            if is_dir:
+                subdirs.append((entry.path, relative_path + "/", ignores))
+            else:
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+def run_git(args, cwd=None):
+    """Run git and return its output as bytes."""
+    import subprocess
+    try:
+        return subprocess.run(["git", "-c", "core.quotePath=false"] + args, cwd=cwd,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise Exception("git {0}: {1}".format(args[0], e.stderr.decode("utf-8", "replace").strip()))
+
+def git_path(path):
+    """Decode a path in git output, which is C-style quoted if it has special characters."""
+    if path.startswith(b"\""):
+        path = codecs.escape_decode(path[1:-1])[0]
+    return os.fsdecode(path)
+
+def git_changed_files(rev, cwd=None):
+    """Return the paths of the files added or modified in the working tree since rev, including untracked ones."""
+    top = os.fsdecode(run_git(["rev-parse", "--show-toplevel"], cwd).rstrip(b"\n"))
+    names = run_git(["diff", "--name-only", "-z", "--no-renames", "--diff-filter=d", rev, "--"], cwd).split(b"\0")
+    # Untracked files are listed from the top, not only those under cwd
+    names += run_git(["ls-files", "--others", "--exclude-standard", "-z", "--full-name"], top).split(b"\0")
+    return [os.path.join(top, os.fsdecode(name)) for name in names if name]
+
+def git_changes(rev_range, settings, cwd=None):
+    """Yield (path, hunks, lines) of each file changed in rev_range, as arguments for Inspector.inspect_hunks.
+
+    rev_range is given to "git diff" as it is, so without ".." the new side is
+    the working tree. The hunks come from the headers of a diff without
+    context lines, the new version of files with a filetype is read from the
+    object store by a single "git cat-file --batch" (or from the working tree),
+    binary files have no hunks and pure renames are never read.
+    """
+    import subprocess
+    top = os.fsdecode(run_git(["rev-parse", "--show-toplevel"], cwd).rstrip(b"\n"))
+    revs = rev_range.split()
+    # New blob id of each file, which is not in the object store if it is in the working tree
+    blobs = {}
+    fields = iter(run_git(["diff", "--raw", "-z", "-M", "--no-abbrev", "--diff-filter=d"] + revs + ["--"], top).split(b"\0"))
+    for field in fields:
+        if field.startswith(b":"):
+            status = field.split()[4]
+            if status[:1] in b"RC":
+                next(fields)
+            blobs[os.fsdecode(next(fields))] = field.split()[3].decode("ascii")
+    diff = subprocess.Popen(["git", "-c", "core.quotePath=false", "diff", "-U0", "-M", "--no-color", "--no-ext-diff",
+        "--no-textconv", "--diff-filter=d", "--src-prefix=a/", "--dst-prefix=b/"] + revs + ["--"],
+        cwd=top, stdout=subprocess.PIPE)
+    cat_file = None
+    try:
+        files = []
+        hunk_re = re.compile(rb"^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+        remaining = 0
+        for line in diff.stdout:
+            if 0 < remaining:
+                # Changed lines, which may start with "+++" or "@@" as well
+                if not line.startswith(b"\\"):
+                    remaining -= 1
+            elif line.startswith(b"+++ "):
+                files.append((git_path(line[4:].rstrip(b"\r\n"))[2:], []))
+            elif line.startswith(b"@@ ") and files:
+                match = hunk_re.match(line)
+                delete_count = 1 if match.group(1) is None else int(match.group(1))
+                add_count = 1 if match.group(3) is None else int(match.group(3))
+                files[-1][1].append((delete_count, int(match.group(2)), add_count))
+                remaining = delete_count + add_count
+        if diff.wait() != 0:
+            raise Exception("git diff failed")
+        for path, hunks in files:
+            lines = None
+            if settings.filetype(path) and any(add_count for delete_count, start, add_count in hunks):
+                data = None
+                blob = blobs.get(path, "0")
+                if blob.strip("0"):
+                    if not cat_file:
+                        cat_file = subprocess.Popen(["git", "cat-file", "--batch"], cwd=top,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                    cat_file.stdin.write(blob.encode("ascii") + b"\n")
+                    cat_file.stdin.flush()
+                    header = cat_file.stdout.readline().split()
+                    if len(header) == 3:
+                        size = int(header[2])
+                        data = cat_file.stdout.read(size + 1)[:size]
+                if data is None:
+                    # Changed files in the working tree are not in the object store
+                    with open(os.path.join(top, path), mode="rb") as f:
+                        data = f.read()
+                lines = split_lines(decode_bytes(data)[0])
+            yield path, hunks, lines
+    finally:
+        diff.stdout.close()
+        diff.wait()
+        if cat_file:
+            cat_file.stdin.close()
+            cat_file.wait()
+
+def inspect_file_report(settings, path, options=None, cache=None):
+    """Inspect one file and return (path, partial report, error message, cache key, cache hit).
+
+    options: Keyword arguments for the Inspector.
+    """
+    key = None
+    if cache:
+        try:
+            key = cache.key(path)
+            report = cache.get(key)
+            if report is not None:
+                return path, report, None, key, True
+        except Exception:
+            # e.g. the cache is locked, the file is inspected and not cached
+            key = None
+    try:
+        inspector = Inspector(settings, **(options or {}))
+        try:
+            inspector.inspect_file(path)
+        except InspectionStopped:
+            # Only part of the file is inspected, so it isn't cached
+            return path, inspector.report, None, None, False
+        return path, inspector.report, None, key, False
+    except:
+        return path, None, str(sys.exc_info()[1]), None, False
+
+_worker_settings = None
+_worker_options = None
+_worker_cache = None
+
+def _init_worker(settings_path, options, cache_path, categories):
+    global _worker_settings, _worker_options, _worker_cache
+    _worker_settings = Settings.load(settings_path)
+    if categories is not None:
+        _worker_settings.restrict(categories)
+    _worker_options = options
+    _worker_cache = ResultCache(cache_path, _worker_settings, None, options) if cache_path else None
+
+def _inspect_worker(path):
+    return inspect_file_report(_worker_settings, path, _worker_options, _worker_cache)
+
+def inspect_files(settings, settings_path, paths, jobs=1, cache=None, options=None):
+    """Yield (path, partial report, error message) for each path in the given order.
+
+    paths may be any iterable and is consumed as the inspection goes. With
+    jobs > 1 the files (including the cache lookups) are spread over worker
+    processes, each one loading its own Settings. Results still come back in
+    input order, so merging them gives the same report as a serial run. Files
+    found in the cache are not inspected at all.
+    """
+    if jobs <= 1:
+        results = (inspect_file_report(settings, path, options, cache) for path in paths)
+        yield from _store_results(settings, results, cache)
+    else:
+        import multiprocessing
+        cache_path = cache and cache.path
+        with multiprocessing.Pool(jobs, _init_worker, (settings_path, options, cache_path, settings.restricted)) as pool:
+            if cache and not cache_path:
+                results = _inspect_misses(pool, paths, cache)
+            else:
+                results = pool.imap(_inspect_worker, paths, 8)
+            yield from _store_results(settings, results, cache)
+
+def _inspect_misses(pool, paths, cache):
+    # A MemoryCache is looked up here, only the files not found go to the workers
+    entries = []
+    for path in paths:
+        try:
+            key = cache.key(path)
+        except OSError:
+            key = None
+        entries.append((path, key, key and cache.get(key)))
+    results = pool.imap(_inspect_worker, [path for path, key, report in entries if report is None], 8)
+    for path, key, report in entries:
+        if report is None:
+            path, report, error, _, hit = next(results)
+            yield path, report, error, None if error else key, False
         else:
-            if os.path.isdir(path) and recursive:
-                travarse_files(glob.glob(os.path.join(path, "*")), recursive, handler)
+            yield path, report, None, key, True
+
+def _store_results(settings, results, cache):
+    for path, report, error, key, hit in results:
+        if error is None:
+            if hit:
+                cache.touch(key)
+            elif key:
+                import sqlite3
+                try:
+                    cache.put(key, report)
+                except sqlite3.Error:
+                    pass
+            report.attach(settings)
+        yield path, report, error
 
-def main(argv, stdin = None):
-    app_dir = os.path.dirname(__file__)
-    output = Output(sys.stdout)
+class Server(object):
+    """Runs main() for the clients connecting to a Unix socket.
+
+    The settings are loaded again only when the file's mtime changes, and the
+    results of files are kept in memory while the files are unchanged.
+
+    Protocol: The client sends a JSON line {"argv": [...], "cwd": ...,
+    "stdin": bool, "tty": bool}. With "stdin", the piped bytes follow as JSON
+    lines {"stdin": text} decoded as UTF-8 with surrogateescape, and
+    {"stdin": null} at the end. The server replies JSON lines
+    {"stdout": text} and {"stderr": text}, and {"exit": status} at the end.
+    A request that fails is replied with the error and a non-zero status.
+    """
+    def __init__(self, settings_path, cache_size=None):
+        """cache_size: Maximum size of the kept results in bytes, None for no limit."""
+        self.__settings_path = settings_path
+        self.__settings = None
+        self.__settings_mtime = None
+        self.__cache = MemoryCache(cache_size)
+
+    def settings(self):
+        mtime = os.stat(self.__settings_path).st_mtime_ns
+        if mtime != self.__settings_mtime:
+            self.__settings = Settings.load(self.__settings_path)
+            self.__settings_mtime = mtime
+            self.__cache.clear()
+        return self.__settings
+
+    def cache(self, options):
+        """Return the MemoryCache for reports made with the options."""
+        self.__cache.namespace = tuple(sorted(options.items()))
+        return self.__cache
+
+    def serve(self, socket_path):
+        import socket
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(socket_path)
+            sock.listen()
+            try:
+                while True:
+                    conn = sock.accept()[0]
+                    with conn, conn.makefile("rwb") as f:
+                        try:
+                            self.__handle(f)
+                        except OSError:
+                            # The client has gone
+                            pass
+                        except Exception as e:
+                            # A broken request, the server goes on
+                            try:
+                                f.write(json.dumps({"stderr": "ERROR: {0}\n".format(e)}).encode("utf-8") + b"\n")
+                                f.write(json.dumps({"exit": 2}).encode("utf-8") + b"\n")
+                                f.flush()
+                            except OSError:
+                                pass
+            finally:
+                os.unlink(socket_path)
+
+    def __handle(self, f):
+        request = json.loads(f.readline().decode("utf-8"))
+        stdin = None
+        if request.get("stdin"):
+            stdin = DecodedLines(ClientInput(f)) or None
+        stdout = ClientStream(f, "stdout", request.get("tty", False))
+        stderr = ClientStream(f, "stderr", request.get("tty", False))
+        import contextlib
+        cwd = os.getcwd()
+        try:
+            os.chdir(request["cwd"])
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                try:
+                    status = main(["pokalint.py"] + request["argv"], stdin, self)
+                except SystemExit as e:
+                    # argparse exits on bad arguments and --help, having output the message
+                    if e.code is None or type(e.code) is int:
+                        status = e.code
+                    else:
+                        Output(sys.stderr).print(str(e.code))
+                        status = 1
+                except Exception as e:
+                    Output(sys.stderr).print("ERROR: {0}".format(e), "red")
+                    status = 2
+        finally:
+            os.chdir(cwd)
+            stdout.flush()
+            stderr.flush()
+        f.write(json.dumps({"exit": status or 0}).encode("utf-8") + b"\n")
+        f.flush()
+
+class ClientInput(object):
+    """A binary stream of the stdin the client of the Server sends, read as it comes."""
+    def __init__(self, file):
+        self.__file = file
+        self.__buffer = b""
+        self.__ended = False
+
+    def read(self, size=-1):
+        """Return size bytes (all if negative), fewer only at the end."""
+        while not self.__ended and (size < 0 or len(self.__buffer) < size):
+            line = self.__file.readline()
+            text = json.loads(line.decode("utf-8"))["stdin"] if line else None
+            if text is None:
+                self.__ended = True
+            else:
+                self.__buffer += text.encode("utf-8", "surrogateescape")
+        data = self.__buffer if size < 0 else self.__buffer[:size]
+        self.__buffer = self.__buffer[len(data):]
+        return data
+
+class ClientStream(object):
+    """A text stream that sends what is written to the client of the Server."""
+    def __init__(self, file, name, tty):
+        self.__file = file
+        self.__name = name
+        self.__tty = tty
+        self.__buffer = []
+        self.__size = 0
+
+    def write(self, text):
+        self.__buffer.append(text)
+        self.__size += len(text)
+        if 65536 <= self.__size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.__buffer:
+            self.__file.write(json.dumps({self.__name: "".join(self.__buffer)}).encode("utf-8") + b"\n")
+            self.__file.flush()
+            self.__buffer = []
+            self.__size = 0
+
+    def isatty(self):
+        return self.__tty
+
+def socket_path(app_dir):
+    return os.environ.get("POKALINT_SOCKET") or os.path.join(app_dir, "pokalint.sock")
+
+def log_dir(app_dir):
+    return os.environ.get("POKALINT_LOG_DIR") or os.path.join(app_dir, "log")
+
+def stats(app_dir, argv):
+    """Output the trends and the top files recorded in the metrics store, for "pokalint.py stats"."""
+    import argparse
+    ap = argparse.ArgumentParser(prog="pokalint.py stats")
+    ap.add_argument("--cwd", dest="cwd", metavar="DIR", default=os.getcwd(), help="Directory the runs were made in (default: current)")
+    ap.add_argument("--since", dest="since", metavar="DATE", default="", help="First day of the runs, as YYYY-MM-DD")
+    ap.add_argument("--period", dest="period", choices=list(MetricsStore.PERIODS), default="week")
+    ap.add_argument("--category", dest="category", metavar="NAME", default=None, help="Counter or warning category (default: all warnings)")
+    ap.add_argument("--dirs", dest="dirs", action="store_true", default=False, help="Output the trend of each directory")
+    ap.add_argument("--top", dest="top", type=int, metavar="N", default=10, help="Number of files in the last run with the most hits")
+    args = ap.parse_args(argv)
+    path = os.path.join(log_dir(app_dir), "metrics.sqlite3")
+    if not os.path.isfile(path):
+        Output(sys.stderr).print("ERROR: No metrics are recorded (make a \"log\" directory next to pokalint.py)", "red")
+        return 2
+    output = Output(sys.stdout, 65536)
+    store = MetricsStore(path)
+    cwd = os.path.abspath(args.cwd)
+
+    output.print("# Trend", "cyan")
+    output.print()
+    output.isatty() or output.print("```")
+    periods = OrderedDict()
+    categories = []
+    for period, runs, category, count in store.trend(cwd, args.since, args.period, args.category):
+        periods.setdefault(period, [runs, {}])[1][category] = count
+        category in categories or categories.append(category)
+    output.print("  {0:10} {1:>5} {2}".format(args.period, "runs", " ".join("{0:>10}".format(c) for c in categories)))
+    for period, (runs, counts) in periods.items():
+        output.print("  {0:10} {1:5} {2}".format(period, runs, " ".join("{0:>10}".format(counts.get(c, "")) for c in categories)))
+    output.isatty() or output.print("```")
+    output.print()
+
+    if args.dirs:
+        output.print("# Trend by directory", "cyan")
+        output.print()
+        output.isatty() or output.print("```")
+        for period, directory, count in store.dir_trend(cwd, args.since, args.period, args.category):
+            output.print("  {0:10} {1:6} {2}".format(period, count, directory))
+        output.isatty() or output.print("```")
+        output.print()
+
+    if 0 < args.top:
+        output.print("# Top files", "cyan")
+        output.print()
+        output.isatty() or output.print("```")
+        for filename, count in store.top_files(cwd, args.category, args.top):
+            output.print("  * {0:6} {1}".format(count, filename))
+        output.isatty() or output.print("```")
+        output.print()
+    store.close()
+    output.close()
+    return 0
+
+def rules_bench(app_dir, argv):
+    """Output the cost of each PatternSet on lines sampled from a corpus, for "pokalint.py rules-bench"."""
+    import argparse
+    ap = argparse.ArgumentParser(prog="pokalint.py rules-bench")
+    ap.add_argument("corpus", metavar="PATH", nargs="+", help="Files or directories (searched recursively) to sample lines from")
+    ap.add_argument("--settings", dest="settings", metavar="FILE", default=os.path.join(app_dir, "pokalint_settings.json"))
+    ap.add_argument("--baseline", dest="baseline", metavar="REV", default="HEAD", help="Commit of the settings file to compare with (default: HEAD, \"\": none)")
+    ap.add_argument("--lines", dest="lines", type=int, metavar="N", default=20000, help="Number of sampled lines (default: 20000)")
+    ap.add_argument("--seed", dest="seed", type=int, default=0)
+    ap.add_argument("--repeat", dest="repeat", type=int, metavar="N", default=3, help="Runs on the lines, the best one is taken (default: 3)")
+    ap.add_argument("--timeout", dest="timeout", type=float, metavar="MS", default=100, help="Time for a match to be taken as catastrophic (default: 100)")
+    ap.add_argument("--tolerance", dest="tolerance", type=float, default=0.2, help="Slowdown from the baseline flagged (default: 0.2)")
+    ap.add_argument("--format", dest="format", choices=["text", "json"], default="text")
+    args = ap.parse_args(argv)
     error_output = Output(sys.stderr)
 
+    settings = Settings(args.settings)
+    baseline = None
+    if args.baseline:
+        directory, filename = os.path.split(os.path.abspath(args.settings))
+        try:
+            source = run_git(["show", "{0}:./{1}".format(args.baseline, filename)], directory)
+            baseline = Settings(args.settings, source)
+        except Exception as e:
+            error_output.print("WARNING: No baseline: {0}".format(e), "yellow")
+    samples, file_count = RulesBench.sample_lines(settings, walk_files(args.corpus, True), max(1, args.lines), args.seed)
+    if not samples:
+        error_output.print("ERROR: No lines in the corpus", "red")
+        return 2
+    bench = RulesBench(samples, args.timeout / 1000, max(1, args.repeat))
+    rows = bench.run(settings)
+    baseline_rows = OrderedDict(((row["label"], row["name"]), row) for row in bench.run(baseline)) if baseline else OrderedDict()
+    for row in rows:
+        row["lines_per_sec"] = round(len(samples) / row["seconds"]) if row["seconds"] else None
+        row["hit_rate"] = row["hits"] / len(samples) if row["seconds"] is not None else None
+        base = baseline_rows.pop((row["label"], row["name"]), None)
+        row["baseline"] = base and OrderedDict((key, base.get(key)) for key in ("seconds", "hits", "patterns"))
+    timeouts = [row for row in rows if row["seconds"] is None]
+
+    if args.format == "json":
+        data = OrderedDict()
+        data["lines"] = len(samples)
+        data["files"] = file_count
+        data["baseline"] = args.baseline if baseline else None
+        data["rules"] = rows
+        data["removed"] = [OrderedDict(label=label, name=name) for label, name in baseline_rows]
+        json.dump(data, sys.stdout, ensure_ascii=False, indent=1)
+        sys.stdout.write("\n")
+        return 1 if timeouts else 0
+
+    output = Output(sys.stdout, 65536)
+    output.print("# Rules benchmark", "cyan")
+    output.print()
+    output.print("{0} lines sampled from {1} files{2}.".format(
+        len(samples), file_count, ", compared with {0}".format(args.baseline) if baseline else ""))
+    output.print()
+    output.isatty() or output.print("```")
+    for row in rows:
+        rule = row["label"] + "/" + row["name"]
+        if row["seconds"] is None:
+            output.print("  * {0:30} - {1:4} patterns TIMEOUT".format(rule, row["patterns"]), "red")
+            continue
+        base = row["baseline"]
+        note = ""
+        color = ""
+        if base is None and baseline:
+            note = " (new)"
+        elif base and base["seconds"] is None:
+            note = " (timed out in {0})".format(args.baseline)
+        elif base:
+            ratio = row["seconds"] / base["seconds"] - 1 if base["seconds"] else 0.0
+            note = " ({0:+.1%} time, {1:+} hits from {2})".format(ratio, row["hits"] - base["hits"], args.baseline)
+            if args.tolerance < ratio:
+                note += " SLOWER"
+                color = "yellow"
+        output.print("  * {0:30} - {1:4} patterns {2:10} lines/s {3:7.2%} hits (worst {4:.3f} ms){5}".format(
+            rule, row["patterns"], row["lines_per_sec"] or 0, row["hit_rate"], row["worst"] * 1000, note), color)
+    for label, name in baseline_rows:
+        output.print("  * {0:30} - removed".format(label + "/" + name))
+    output.isatty() or output.print("```")
+    output.print()
+    measured = [row for row in rows if row["seconds"] is not None]
+    total = sum(row["seconds"] for row in measured)
+    output.print("Total {0:.3f} ms for {1} lines ({2} lines/s).".format(
+        total * 1000, len(samples), round(len(samples) / total) if total else "-"))
+    both = [row for row in measured if row["baseline"] and row["baseline"]["seconds"]]
+    if both:
+        output.print("{0:+.1%} time from {1} for the {2} sets in both.".format(
+            sum(row["seconds"] for row in both) / sum(row["baseline"]["seconds"] for row in both) - 1, args.baseline, len(both)))
+    for row in timeouts:
+        output.print()
+        output.print("A match of {0}/{1} took more than {2} ms, on the line:".format(row["label"], row["name"], args.timeout), "red")
+        output.print("    " + row["timeout_line"])
+        for text in row["timeout_patterns"]:
+            output.print("  by the pattern: {0}".format(text), "red")
+    output.print()
+    output.close()
+    return 1 if timeouts else 0
+
+def rollup_depth(value):
+    """Parse the value of --rollup, "depth=N" (N >= 1)."""
+    match = re.fullmatch(r"(?:depth=)?0*([1-9]\d*)", value)
+    if not match:
+        raise ValueError(value)
+    return int(match.group(1))
+
+def main(argv, stdin = None, server = None):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    # A file named like a command is given after "--"
+    if argv[1:2] == ["stats"]:
+        return stats(app_dir, argv[2:])
+    if argv[1:2] == ["rules-bench"]:
+        return rules_bench(app_dir, argv[2:])
+
+    import argparse
     ap = argparse.ArgumentParser(add_help=False)
     ap.add_argument("-r", "--recursive", dest="recursive", action="store_true", required=False, default=False)
     ap.add_argument("-v", "--verbose", dest="verbose", action="store_true", required=False, default=False)
+    ap.add_argument("--exclude", dest="excludes", metavar="GLOB", action="append", required=False, default=[])
+    ap.add_argument("--no-gitignore", dest="gitignore", action="store_false", required=False, default=True)
+    ap.add_argument("--git", dest="git", metavar="REV_RANGE", required=False, default=None)
+    ap.add_argument("--changed-since", dest="changed_since", metavar="REV", required=False, default=None)
+    ap.add_argument("-j", "--jobs", dest="jobs", type=int, required=False, default=1)
+    ap.add_argument("-s", "--stream", dest="stream", action="store_true", required=False, default=False)
+    ap.add_argument("--no-cache", dest="cache", action="store_false", required=False, default=True)
+    ap.add_argument("--cache-size", dest="cache_size", type=int, required=False, default=64)
+    ap.add_argument("--mmap-threshold", dest="mmap_threshold", type=float, required=False, default=32)
+    ap.add_argument("--max-warnings-per-category", dest="max_warnings", type=int, required=False, default=None)
+    ap.add_argument("--max-funccalls", dest="max_funccalls", type=int, required=False, default=None)
+    ap.add_argument("--top-funccalls", dest="top_funccalls", type=int, required=False, default=None)
+    ap.add_argument("--rollup", dest="rollup", metavar="depth=N", type=rollup_depth, required=False, default=None)
+    ap.add_argument("--top-dirs", dest="top_dirs", metavar="N", type=int, required=False, default=None)
+    ap.add_argument("--format", dest="format", choices=["text"] + list(WRITERS), required=False, default="text")
+    ap.add_argument("--profile-rules", dest="profile_rules", action="store_true", required=False, default=False)
+    ap.add_argument("--profile-threshold", dest="profile_threshold", type=float, required=False, default=1.0)
+    ap.add_argument("--compile-settings", dest="compile_settings", action="store_true", required=False, default=False)
+    ap.add_argument("--serve", dest="serve", action="store_true", required=False, default=False)
+    ap.add_argument("--check", dest="check", action="store_true", required=False, default=False)
+    ap.add_argument("--check-category", dest="check_categories", metavar="NAME", action="append", required=False, default=[])
+    ap.add_argument("--max-hits", dest="max_hits", type=int, required=False, default=1)
     ap.add_argument("--help", action="help")
     ap.add_argument("files", metavar="FILE", nargs="*")
     args = ap.parse_args(args=argv[1:])
+    # The categories to check (all if empty), None without --check; --check-category implies it
+    categories = [name for value in args.check_categories for name in value.split(",") if name]
+    args.check = categories if args.check or categories else None
+    # Streamed warnings are written while the next files are inspected
+    output = Output(sys.stdout, 65536, args.stream)
+    error_output = Output(sys.stderr)
 
-    if output.isatty():
+    if args.serve and not server:
+        error_output.print("Listening on {0}".format(socket_path(app_dir)))
+        try:
+            Server(os.path.join(app_dir, "pokalint_settings.json"), args.cache_size * 1024 * 1024).serve(socket_path(app_dir))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if output.isatty() and args.format == "text" and args.check is None:
         print_banner(output)
 
+    failed = False
+    writer = None
+
     try:
-        settings = Settings(os.path.join(app_dir, "pokalint_settings.json"))
-        inspector = Inspector(settings)
-        if stdin:
-            inspector.inspect_diff(stdin)
+        settings_path = os.path.join(app_dir, "pokalint_settings.json")
+        # The profiler is set to the settings, so they are not shared with other runs
+        if args.compile_settings:
+            error_output.print("Compiled {0}".format(Settings(settings_path).write_bundle(settings_path)))
+            return
+        settings = server.settings() if server and not args.profile_rules and args.check is None else Settings.load(settings_path)
+        options = {
+            "mmap_threshold": int(args.mmap_threshold * 1024 * 1024) if 0 <= args.mmap_threshold else None,
+            "max_warnings": args.max_warnings,
+            "max_funccalls": args.max_funccalls}
+        profiler = None
+        if args.profile_rules:
+            # Every line goes through the plain text path of this process
+            profiler = RuleProfiler()
+            settings.set_profiler(profiler)
+            options["mmap_threshold"] = None
+            args.jobs = 1
+            args.cache = False
+        if args.check is not None:
+            # Stop at the first hits, the partial reports aren't cached
+            settings.restrict(args.check)
+            options["max_hits"] = max(1, args.max_hits)
+            args.cache = False
+            args.stream = False
+            args.format = "text"
+        writer = WRITERS[args.format](sys.stdout, settings) if args.format in WRITERS else None
+        if writer:
+            listener = writer.write_warnings
+        elif args.stream:
+            def listener(report):
+                report.output_warning_details(output)
+                output.flush()
+        else:
+            listener = None
+        inspector = Inspector(settings, listener, **options)
+        if args.git or stdin:
+            try:
+                if args.git:
+                    for path, hunks, lines in git_changes(args.git, settings):
+                        inspector.inspect_hunks(path, hunks, lines)
+                else:
+                    inspector.inspect_diff(stdin)
+            except InspectionStopped:
+                pass
+            if stdin and args.verbose and getattr(stdin, "encoding", None):
+                error_output.print("<stdin> ({0})".format(stdin.encoding))
         else:
-            def handler(path):
-                abspath = os.path.abspath(path)
-                if settings.filter.match(abspath):
-                    try:
-                        inspector.inspect_file(abspath)
-                        if args.verbose:
-                            error_output.print(abspath)
-                    except:
-                        error_output.print("{0} - ERROR: {1}".format(abspath, sys.exc_info()[1]), "red")
-            travarse_files(args.files, args.recursive, handler)
-        inspector.report.output(output)
+            cache = None
+            if args.changed_since:
+                paths = git_changed_files(args.changed_since)
+            else:
+                paths = (os.path.abspath(path) for path in walk_files(args.files, args.recursive, args.excludes, args.gitignore))
+            paths = (path for path in paths if settings.filetype(path))
+            jobs = args.jobs if 0 < args.jobs else os.cpu_count()
+            cache_dir = os.path.join(app_dir, "cache")
+            if server and args.cache and not args.profile_rules:
+                cache = server.cache(options)
+            elif args.cache and os.path.isdir(cache_dir):
+                cache = ResultCache(os.path.join(cache_dir, "results.sqlite3"), settings, args.cache_size * 1024 * 1024, options)
+            for path, report, error in inspect_files(settings, settings_path, paths, jobs, cache, options):
+                if error is None:
+                    if listener:
+                        listener(report)
+                    inspector.report.merge(report)
+                    if args.verbose:
+                        error_output.print("{0} ({1})".format(path, report.encoding_of(path)))
+                    if args.check is not None and options["max_hits"] <= inspector.report.total_warning_count():
+                        break
+                else:
+                    error_output.print("{0} - ERROR: {1}".format(path, error), "red")
+                    failed = True
+            if cache:
+                cache.close()
+        inspector.report.funccall_top = args.top_funccalls
+        inspector.report.rollup_depth = args.rollup
+        inspector.report.top_dirs = args.top_dirs
+        if args.check is not None:
+            inspector.report.output_warning_details(output)
+            return 1 if inspector.report.total_warning_count() else 2 if failed else 0
+        if writer:
+            writer.finish(inspector.report)
+        else:
+            inspector.report.output(output, not args.stream)
+        if profiler:
+            profiler.output(error_output, args.profile_threshold / 1000)
     except:
+        if writer:
+            writer.abort(str(sys.exc_info()[1]))
+        output.flush()
         error_output.print("ERROR: {0}".format(sys.exc_info()[1]), "red")
-        return
+        return 2
+    finally:
+        output.close()
+
+    metrics_dir = log_dir(app_dir)
+    if os.path.isdir(metrics_dir):
+        inspector.report.write_log(metrics_dir)
+        store = MetricsStore(os.path.join(metrics_dir, "metrics.sqlite3"))
+        store.record(inspector.report, os.getcwd())
+        store.close()
+    return 2 if failed else 0
 
-    log_dir = os.path.join(app_dir, "log")
-    if os.path.isdir(log_dir):
-        inspector.report.write_log(log_dir)
+def read_stdin():
+    """Return an iterator over the lines on STDIN, or None if nothing was piped in."""
+    if sys.stdin.isatty():
+        return None
+    lines = DecodedLines(sys.stdin.buffer)
+    return lines if lines else None
 
 if __name__ == "__main__":
-    stdin = sys.stdin.readlines() if not sys.stdin.isatty() else None
-    main(sys.argv, stdin)
+    sys.exit(main(sys.argv, read_stdin()))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""Thin client of "pokalint.py --serve".
+
+Takes the same arguments as pokalint.py. If no server is listening, it runs
+pokalint.py in this process instead.
+"""
+
+import os
+import sys
+import json
+import socket
+import threading
+
+def send_stdin(sock, stdin):
+    """Send the stream to the server in chunks, which it reads while the replies come."""
+    try:
+        for chunk in iter(lambda: stdin.read(65536), b""):
+            sock.sendall(json.dumps({"stdin": chunk.decode("utf-8", "surrogateescape")}).encode("utf-8") + b"\n")
+        sock.sendall(json.dumps({"stdin": None}).encode("utf-8") + b"\n")
+    except OSError:
+        # The server has replied without reading all
+        pass
+
+def request(socket_path, argv, stdin=None, stdout=sys.stdout, stderr=sys.stderr, tty=False):
+    """Run pokalint.py with argv (without the program name) on the server and return the exit status.
+
+    stdin: Binary stream piped into pokalint.py, or None
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        data = {"argv": argv, "cwd": os.getcwd(), "tty": tty, "stdin": stdin is not None}
+        sock.sendall(json.dumps(data).encode("utf-8") + b"\n")
+        if stdin is not None:
+            threading.Thread(target=send_stdin, args=(sock, stdin), daemon=True).start()
+        with sock.makefile("rb") as f:
+            for line in f:
+                reply = json.loads(line.decode("utf-8"))
+                if "stdout" in reply:
+                    stdout.write(reply["stdout"])
+                    stdout.flush()
+                elif "stderr" in reply:
+                    stderr.write(reply["stderr"])
+                    stderr.flush()
+                elif "exit" in reply:
+                    return reply["exit"]
+    raise ConnectionError("The server closed the connection")
+
+def main(argv):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    socket_path = os.environ.get("POKALINT_SOCKET") or os.path.join(app_dir, "pokalint.sock")
+    stdin = None if sys.stdin.isatty() else sys.stdin.buffer
+    try:
+        return request(socket_path, argv[1:], stdin, tty=sys.stdout.isatty())
+    except (FileNotFoundError, ConnectionRefusedError):
+        sys.path.insert(0, app_dir)
+        import pokalint
+        lines = pokalint.DecodedLines(stdin) if stdin else None
+        return pokalint.main(["pokalint.py"] + argv[1:], lines or None)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
 
 import pokalint
+import pytest
 import re
+import sqlite3
+import subprocess
 import pdb
 
+@pytest.fixture(autouse=True)
+def log_dir(tmp_path, monkeypatch):
+    """Keep the runs of main() out of the log directory next to pokalint.py."""
+    path = tmp_path / "log"
+    path.mkdir()
+    monkeypatch.setenv("POKALINT_LOG_DIR", str(path))
+    return path
+
 def test_pattern():
     p = pokalint.Pattern("hoge")
     assert(p)
@@ -45,11 +56,32 @@ def test_main_stdin1(capfd):
 def test_main_stdin2(capfd):
     with open("test/helloworld.c", mode="r", encoding="utf-8") as f:
         lines = f.readlines()
-    pokalint.main(["pokalint.py"], lines)
+    assert(pokalint.main(["pokalint.py"], lines) == 2)
     o, e = capfd.readouterr()
     assert(not o)
     assert("Invalid diff format" in e)
 
+def test_main_check(capfd):
+    with open("test/diff_git.txt", mode="r", encoding="utf-8") as f:
+        lines = f.readlines()
+    assert(pokalint.main(["pokalint.py", "--check-category", "Typo", "--max-hits", "2"], lines) == 1)
+    o, e = capfd.readouterr()
+    assert(o.startswith("# Typo (2)") and o.count("```") == 4 and "# Summary" not in o)
+    assert(pokalint.main(["pokalint.py", "--check", "test/helloworld.c"]) == 1)
+    assert(pokalint.main(["pokalint.py", "--check-category", "Deprecated", "test/helloworld.c"]) == 1)
+    assert(pokalint.main(["pokalint.py", "--check-category", "Typo", "test/helloworld.c"]) == 0)
+    assert(pokalint.main(["pokalint.py", "--check-category", "Typo,Deprecated", "test/helloworld.c"]) == 1)
+    assert(pokalint.main(["pokalint.py", "--check-category", "Unknown"], lines) == 2)
+    assert(pokalint.main(["pokalint.py", "test/helloworld.c"]) == 0)
+
+def test_main_log_dir(log_dir, capfd):
+    assert(pokalint.main(["pokalint.py", "test/helloworld.c"]) == 0)
+    assert(sorted(p.suffix for p in log_dir.iterdir()) == [".log", ".sqlite3"])
+    # A file named like a command
+    assert(pokalint.main(["pokalint.py", "--", "stats"]) == 0)
+    o, e = capfd.readouterr()
+    assert("# Trend" not in o and "# Summary" in o)
+
 def test_main_args1(capfd):
     pokalint.main(["pokalint.py", "test/helloworld.c"])
     o, e = capfd.readouterr()
@@ -63,12 +95,12 @@ def test_main_args2(capfd):
 def test_main_args3(capfd):
     pokalint.main(["pokalint.py", "test/*"])
     o, e = capfd.readouterr()
-    verify_output(o, e, [10, 9, 11])
+    verify_output(o, e, [18, 17, 19])
 
 def test_main_args4(capfd):
     pokalint.main(["pokalint.py", "test/*", "-v"])
     o, e = capfd.readouterr()
-    verify_output(o, e, [10, 9, 11])
+    verify_output(o, e, [18, 17, 19], verbose=True)
 
 def test_main_args5(capfd):
     pokalint.main(["pokalint.py", "test/notfound.c"])
@@ -83,11 +115,11 @@ def test_main_args6(capfd):
 def test_main_args7(capfd):
     pokalint.main(["pokalint.py", "*", "-r"])
     o, e = capfd.readouterr()
-    verify_output(o, e, [10, 9, 11])
+    verify_output(o, e, [18, 17, 19])
 
 def verify_output(o, e, counts, verbose=False, notfound=False):
     if verbose:
-        assert("diff_git.txt" in e)
+        assert("helloworld_sjis.c (cp932)" in e)
     else:
         assert(len(e) == 0 or "ERROR" in e)
 
@@ -102,3 +134,516 @@ def verify_output(o, e, counts, verbose=False, notfound=False):
         assert(re.search(r"printf +- +{0} {1}".format(counts[1], "#" * counts[1]), o) is not None)
     if 0 < counts[2]:
         assert(re.search(r"Deprecated +- +{0} {1}".format(counts[2], "#" * counts[2]), o) is not None)
+
+def settings_root():
+    """Return the contents of pokalint_settings.json, for a test to change."""
+    with open("pokalint_settings.json", encoding="utf-8") as f:
+        return pokalint.json.load(f, object_pairs_hook=pokalint.OrderedDict)
+
+def test_pattern_group():
+    g = pokalint.PatternGroup({"A":["world"], "B":["/h\\w+/", {"pattern":"/=\\s*{/", "only":["C++"]}]})
+    m = g.match("hello, world")
+    assert(m["name"] == "A" and (m["start"], m["end"]) == (7, 12))
+    m = g.match("hello")
+    assert(m["name"] == "B" and (m["start"], m["end"]) == (0, 5))
+    assert(not g.match("x = {0}"))
+    assert(g.match("x = {0}", "C++")["name"] == "B")
+    s = pokalint.PatternSet(None, ["if", "for"])
+    assert(s.match("for", fullmatch=True))
+    assert(not s.match("form", fullmatch=True))
+    g = pokalint.PatternGroup({"A":["/(a)\\1/"], "B":["b"]})
+    assert(g.match("xaab")["name"] == "A")
+
+def test_name_set():
+    names = pokalint.NameSet(["if", "for", "/^_+\\w*$/", {"pattern": "while"}, {"pattern": "main", "only": ["c"]}])
+    assert("if" in names and "while" in names and "__func" in names)
+    assert("iff" not in names and "f_" not in names and "main" not in names)
+    assert(pokalint.required_chars(re.compile(r"(\w+)\s*\(")) == {"("})
+    assert(pokalint.required_chars(re.compile(r"a(?:bc|dc)+e?")) == {"a", "c"})
+    assert(pokalint.required_chars(re.compile(r"abc", re.I)) == set())
+
+def test_top_counter():
+    names = ["a"] * 50 + ["b"] * 30 + ["c"] * 10 + ["d", "e", "f", "g", "h"] * 2
+    exact = pokalint.TopCounter()
+    bounded = pokalint.TopCounter(4)
+    parts = [pokalint.TopCounter(4), pokalint.TopCounter(4)]
+    for i, name in enumerate(names):
+        exact.add(name)
+        bounded.add(name)
+        parts[i % 2].add(name)
+    merged = pokalint.TopCounter(4)
+    for part in parts:
+        merged.merge(part)
+    assert(exact.exact and exact.top(3) == [("a", 50), ("b", 30), ("c", 10)])
+    for counter in (bounded, merged):
+        assert(not counter.exact and len(counter) == 4 and counter.total == len(names))
+        assert([name for name, count in counter.top(3)] == ["a", "b", "c"])
+        for name, count in counter.top():
+            assert(count - counter.error(name) <= exact.count(name) <= count)
+    small = pokalint.TopCounter(4)
+    small.merge(parts[0])
+    assert(small.top(2) == [("a", 25), ("b", 15)])
+    # Exact counters of files are counted in as their names would be added
+    files = pokalint.TopCounter(4)
+    for i in range(0, len(names), 7):
+        part = pokalint.TopCounter(4)
+        for name in names[i:i + 7]:
+            part.add(name)
+        files.merge(part)
+    assert(files.total == len(names) and [name for name, count in files.top(3)] == ["a", "b", "c"])
+    for name, count in files.top():
+        assert(count - files.error(name) <= exact.count(name) <= count)
+
+def test_output():
+    class Terminal(pokalint.io.StringIO):
+        def isatty(self):
+            return True
+    for background in (False, True):
+        f = Terminal()
+        output = pokalint.Output(f, 16, background)
+        output.print("abc", "*red", False)
+        output.print(" def")
+        for i in range(10):
+            output.print(str(i))
+        output.close()
+        assert(f.getvalue() == pokalint.concolor.get("abc", "red", True) + " def\n" + "".join("{0}\n".format(i) for i in range(10)))
+    assert(pokalint.strlen_on_screen("a\tb") == 3)
+    assert(pokalint.strlen_on_screen("aあ漢b") == 6)
+
+def test_metrics_store(tmp_path):
+    settings = pokalint.Settings("./pokalint_settings.json")
+    inspector = pokalint.Inspector(settings)
+    inspector.inspect_file(pokalint.os.path.abspath("test/helloworld.c"))
+    cwd = pokalint.os.getcwd()
+    store = pokalint.MetricsStore(str(tmp_path / "metrics.sqlite3"))
+    for time in ("2026-10-05T10:00:00", "2026-10-06T10:00:00", "2026-10-13T10:00:00"):
+        store.record(inspector.report, cwd, time)
+    store.record(inspector.report, "/elsewhere", "2026-10-13T11:00:00")
+    assert(store.trend(cwd) == [("2026W41", 2, "Deprecated", 2), ("2026W41", 2, "Typo", 0), ("2026W42", 1, "Deprecated", 2), ("2026W42", 1, "Typo", 0)])
+    assert(store.trend(cwd, "2026-10-10", "month", "Deprecated") == [("2026-10", 1, "Deprecated", 2)])
+    assert(store.dir_trend(cwd, period="day") == [("2026-10-05", "test", 2), ("2026-10-06", "test", 2), ("2026-10-13", "test", 2)])
+    assert(store.top_files(cwd) == [("test/helloworld.c", 2)])
+    store.close()
+
+def test_directory_tree():
+    def totals(files, warnings={}, counts={}):
+        totals = pokalint.DirectoryTotals()
+        totals.files, totals.warnings, totals.counts = files, dict(warnings), dict(counts)
+        return totals
+    tree = pokalint.DirectoryTree()
+    tree.add("a/b/c", totals(2))
+    tree.add("a/b/c", totals(0, {"W": 3}))
+    tree.add("a", totals(1, {"W": 1}))
+    tree.add("a/b", totals(1, {}, {"C": 2}))
+    tree.add("x", totals(1))
+    assert([(p, t.files, t.warnings, t.counts) for p, t in tree.rollup(2)] == [
+        ("a", 4, {"W": 4}, {"C": 2}), (pokalint.os.path.join("a", "b"), 3, {"W": 3}, {"C": 2}), ("x", 1, {}, {})])
+    assert([(p, t.warning_count()) for p, t in tree.top(2)] == [(pokalint.os.path.join("a", "b", "c"), 3), ("a", 1)])
+    assert([(p, t.warning_count()) for p, t in tree.top(2, 1)] == [("a", 4), ("x", 0)])
+    settings = pokalint.Settings("./pokalint_settings.json")
+    inspector = pokalint.Inspector(settings)
+    inspector.inspect_file("test/helloworld.c")
+    inspector.inspect_file("test/helloworld.cpp")
+    rollup = inspector.report.directory_tree().rollup(1)
+    assert([(p, t.files, t.warnings) for p, t in rollup] == [("test", 2, {"Deprecated": 5})])
+    with pytest.raises(SystemExit):
+        pokalint.main(["pokalint.py", "--rollup", "depth=0", "test/helloworld.c"])
+
+def test_rules_bench():
+    root = settings_root()
+    root["warning"]["Slow"] = ["fine", "/(a+)+$/"]
+    settings = pokalint.Settings(None, pokalint.json.dumps(root).encode("utf-8"))
+    samples, file_count = pokalint.RulesBench.sample_lines(settings, ["test/helloworld.c"], 5)
+    assert(file_count == 1 and len(samples) == 5 and all(filetype == "C" for filetype, line in samples))
+    bench = pokalint.RulesBench(samples + [(None, "a" * 40 + "b")], 0.05, 1)
+    rows = {row["name"]: row for row in bench.run(settings)}
+    assert(rows["Deprecated"]["seconds"] is not None and rows["Deprecated"]["patterns"] == 4)
+    assert(rows["Slow"]["seconds"] is None and rows["Slow"]["timeout_patterns"] == ["/(a+)+$/"])
+
+def test_literal_set():
+    literals = pokalint.LiteralSet([(1, "abc"), (2, "ab"), (3, "b"), (5, "bcd"), (6, "ab")])
+    assert(literals.lowest("xabcd") == 1 and literals.lowest("xab") == 2 and literals.lowest("bc") == 3)
+    assert(literals.lowest("xyz") is None and literals.fullmatch("ab") == 2 and literals.fullmatch("abcd") is None)
+    entries = [("Typo", pokalint.Pattern(p)) for p in ["chagne", "/ch\\w+ck/", "chack", "cha", "colr", "clor", "pallet", "serch", "fromat", "convart"]]
+    matcher = pokalint.PatternMatcher(entries)
+    plain = pokalint.PatternMatcher(entries)
+    plain.literal_set_min = len(entries) + 1
+    for s in ["a chack chagne", "chack", "cha cha", "xx colr clor chack", "serch", "nothing", ""]:
+        for fullmatch in (False, True):
+            m, p = matcher.match(s, None, fullmatch), plain.match(s, None, fullmatch)
+            assert((m and (m["index"], m["start"], m["end"])) == (p and (p["index"], p["start"], p["end"])))
+
+def test_c_lexer():
+    lexer = pokalint.CLexer()
+    lines = ['a = "x//y"; // c "s"', "/* c1", "c2 */ b = 1'000 + '\\''; /* c3 */", 'c = R"d(r1', 'r2)d" + "s\\', 'x" + f(1);']
+    views = [lexer.views(line, ("code", "comment", "string")) for line in lines]
+    assert(views[0] == {"code": 'a = "    ";         ', "comment": '            // c "s"', "string": '     x//y           '})
+    assert(views[1] == {"comment": "/* c1"})
+    assert(views[2] == {"code": "      b = 1'000 + '  ';         ", "comment": "c2 */                   /* c3 */", "string": "                   \\'           "})
+    assert(views[3] == {"code": 'c = R"d(  ', "string": '        r1'})
+    assert(views[4]["string"] == 'r2       s\\' and views[5]["string"] == "x         ")
+
+def test_inspector_regions(tmp_path):
+    root = settings_root()
+    root["lexer"] = {"C": "c"}
+    root["function-settings"]["region"] = "code"
+    root["counter"]["printf"] = {"pattern": "/\\w*printf\\w*/", "region": "code"}
+    root["warning"]["Typo"] = [{"pattern": "fromat", "region": "comment"}, {"pattern": "serch", "region": "string"}]
+    settings = pokalint.Settings(None, pokalint.json.dumps(root).encode("utf-8"))
+    source = tmp_path / "a.c"
+    source.write_text('/* fromat\n printf("serch"); fromat */\nvoid f() {\n\tprintf("fromat serch"); // fromat\n\tputs("fromat serch");\n}\n')
+    inspector = pokalint.Inspector(settings)
+    inspector.inspect_file(str(source))
+    r = inspector.report
+    assert([(d["line"], d["column"], d["match"]) for d in r.warning_data()] == [(1, 4, "fromat"), (2, 19, "fromat"), (4, 29, "fromat"), (5, 15, "serch")])
+    assert(r.data()["counts"]["printf"] == 1 and sorted(r.data()["funccalls"]) == ["printf", "puts"])
+    # In a diff, context lines carry the state of a block comment
+    inspector = pokalint.Inspector(settings)
+    inspector.inspect_diff(["--- a/b.c\n", "+++ b/b.c\n", "@@ -1,2 +1,3 @@\n", " /*\n", "+printf(x); serch\n", " */\n", "+printf(x); fromat\n"])
+    r = inspector.report
+    assert(r.data()["counts"]["printf"] == 1 and r.warning_count("Typo") == 0)
+    with pytest.raises(Exception):
+        pokalint.Pattern({"pattern": "x", "region": "comments"})
+
+def test_inspector_windows(tmp_path):
+    root = settings_root()
+    root["warning"]["Window"] = [
+        {"pattern": "/\\bmalloc\\(/", "window": 2, "unless": "/NULL/"},
+        {"pattern": "/\\w+\\(\\s*\\n\\s*\\w+\\)/", "window": 2}]
+    settings = pokalint.Settings(None, pokalint.json.dumps(root).encode("utf-8"))
+    lines = ["int main() {", "\tp = malloc(1);", "\tif (!p) {}", "\tif (p == NULL) {}", "\tq = malloc(2);", "\tfoo(", "\t\tx);", "\tr = malloc(3);"]
+    source = tmp_path / "a.c"
+    source.write_text("\n".join(lines) + "\n")
+    inspector = pokalint.Inspector(settings)
+    inspector.inspect_file(str(source))
+    warnings = [(d["line"], d["column"], d["match"]) for d in inspector.report.warning_data() if d["category"] == "Window"]
+    assert(sorted(warnings) == [(5, 6, "malloc("), (6, 2, "foo("), (8, 6, "malloc(")])
+    # Context lines of a diff clear a hit, but aren't hit themselves
+    inspector = pokalint.Inspector(settings)
+    inspector.inspect_diff(["--- a/b.c\n", "+++ b/b.c\n", "@@ -1,3 +1,4 @@\n", " a = malloc(1);\n", "+b = malloc(2);\n", " if (b == NULL) {}\n", "+c = malloc(3);\n"])
+    assert([(d["line"], d["text"]) for d in inspector.report.warning_data() if d["category"] == "Window"] == [(4, "c = malloc(3);")])
+    inspector = pokalint.Inspector(settings)
+    inspector.inspect_hunks("b.c", [(0, 2, 1), (0, 6, 1)], lines)
+    assert([d["line"] for d in inspector.report.warning_data() if d["category"] == "Window"] == [6])
+    # Hunks close together are one window, a match isn't found again in the next hunk
+    inspector = pokalint.Inspector(settings)
+    inspector.inspect_hunks("b.c", [(0, 1, 1), (0, 2, 1)], ["foo(", "x);"])
+    assert([(d["line"], d["text"]) for d in inspector.report.warning_data() if d["category"] == "Window"] == [(1, "foo(")])
+    # A match starting on a context line hits the first added line in it
+    inspector = pokalint.Inspector(settings)
+    inspector.inspect_diff(["--- a/b.c\n", "+++ b/b.c\n", "@@ -1,1 +1,2 @@\n", " foo(\n", "+x);\n"])
+    assert([(d["line"], d["column"], d["match"]) for d in inspector.report.warning_data() if d["category"] == "Window"] == [(2, 1, "x)")])
+    with pytest.raises(Exception):
+        pokalint.Pattern({"pattern": "x", "unless": "y"})
+    with pytest.raises(Exception):
+        pokalint.Pattern({"pattern": "x", "window": 2, "region": "code"})
+
+def test_main_jobs(capfd):
+    pokalint.main(["pokalint.py", "test/*"])
+    o1, e1 = capfd.readouterr()
+    pokalint.main(["pokalint.py", "test/*", "-j", "2"])
+    o2, e2 = capfd.readouterr()
+    verify_output(o2, e2, [18, 17, 19])
+    assert(o1 == o2)
+    assert(e1 == e2)
+
+def test_inspector_stream():
+    settings = pokalint.Settings("./pokalint_settings.json")
+    sections = []
+    inspector = pokalint.Inspector(settings, sections.append)
+    with open("test/diff_git.txt", encoding="utf-8") as f:
+        inspector.inspect_diff(line for line in f)
+    r = inspector.report
+    assert(r.added_block_count == 9)
+    assert(r.pure_added_line_count == 46)
+    assert(sum(s.added_block_count for s in sections) == 9)
+    assert(1 < len(sections))
+
+def test_result_cache(tmp_path):
+    settings = pokalint.Settings("./pokalint_settings.json")
+    paths = [pokalint.os.path.abspath("test/helloworld.c")]
+    cache = pokalint.ResultCache(str(tmp_path / "results.sqlite3"), settings, 1024 * 1024)
+    path, report1, error = list(pokalint.inspect_files(settings, None, paths, cache=cache))[0]
+    cache.close()
+    cache = pokalint.ResultCache(str(tmp_path / "results.sqlite3"), settings, 1024 * 1024)
+    key = cache.key(paths[0])
+    report2 = cache.get(key)
+    assert(report2 is not None)
+    assert(list(pokalint.inspect_files(settings, None, paths, cache=cache))[0][1].non_diff_line_count == report1.non_diff_line_count)
+    cache.close()
+    cache = pokalint.ResultCache(str(tmp_path / "results.sqlite3"), settings, 0)
+    cache.close()
+    cache = pokalint.ResultCache(str(tmp_path / "results.sqlite3"), settings, 0)
+    assert(cache.get(key) is None)
+    cache.close()
+    # Puts are committed in batches, readers see them before close()
+    cache = pokalint.ResultCache(str(tmp_path / "results.sqlite3"), settings, 1024 * 1024)
+    cache.commit_interval = 1
+    cache.put(key, report1)
+    reader = pokalint.ResultCache(str(tmp_path / "results.sqlite3"), settings, None)
+    assert(reader.get(key) is not None)
+    reader.close()
+    cache.close()
+    # A cache that can't be read doesn't fail the file
+    class LockedCache(pokalint.MemoryCache):
+        def get(self, key):
+            raise sqlite3.OperationalError("database is locked")
+    path, report, error, key, hit = pokalint.inspect_file_report(settings, paths[0], None, LockedCache())
+    assert(error is None and key is None and report.warning_count("Deprecated") == 2)
+
+def test_result_cache_options(tmp_path):
+    settings = pokalint.Settings("./pokalint_settings.json")
+    paths = [pokalint.os.path.abspath("test/helloworld.c")]
+    options = {"mmap_threshold": None, "max_warnings": 1000, "max_funccalls": 1000}
+    expected = list(pokalint.inspect_files(settings, None, paths, options=options))[0][1].data()
+    # A report made with caps is not a hit for a run without them
+    for max_warnings, max_funccalls in [(1, 1), (1000, 1000)]:
+        options = {"mmap_threshold": None, "max_warnings": max_warnings, "max_funccalls": max_funccalls}
+        cache = pokalint.ResultCache(str(tmp_path / "results.sqlite3"), settings, 1024 * 1024, options)
+        path, report, error = list(pokalint.inspect_files(settings, None, paths, cache=cache, options=options))[0]
+        cache.close()
+    assert(report.data() == expected)
+
+def test_walk_files(tmp_path):
+    files = ["a.c", "b.o", "build/x.c", "lib/keep.c", "lib/skip.c", "lib/sub/y.c", "lib/sub/z.h", "third/w.c", ".git/HEAD"]
+    for name in files:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("int a;\n")
+    (tmp_path / ".gitignore").write_text("# comment\n*.o\nbuild/\n/lib/s*.c\n")
+    (tmp_path / "lib" / ".gitignore").write_text("sub/*\n!sub/y.c\n")
+    def walk(**args):
+        root = str(tmp_path)
+        return [pokalint.os.path.relpath(p, root).replace("\\", "/") for p in pokalint.walk_files([root], True, **args)]
+    assert(walk() == [".gitignore", "a.c", "lib/.gitignore", "lib/keep.c", "lib/sub/y.c", "third/w.c"])
+    assert(walk(excludes=["third", "*.gitignore"]) == ["a.c", "lib/keep.c", "lib/sub/y.c"])
+    assert(len(walk(gitignore=False)) == len(files) + 1)
+    assert(list(pokalint.walk_files([str(tmp_path)], False)) == [])
+    settings = pokalint.Settings("./pokalint_settings.json")
+    assert(settings.filetype("/x/a.c") == settings.filetype("b.c") and settings.filetype("b.c"))
+    assert(settings.filetype("a.o") is None)
+
+def test_git_changes(tmp_path, monkeypatch, capfd):
+    def git(*args):
+        subprocess.run(["git", "-c", "user.name=x", "-c", "user.email=x@x"] + list(args), cwd=str(tmp_path), check=True, stdout=subprocess.PIPE)
+    git("init", "-q")
+    (tmp_path / "a.c").write_text("int a;\n\nint b;\nint c;\n")
+    (tmp_path / "b.cpp").write_text("int main() {\n  return 0;\n}\n")
+    (tmp_path / "c.bin").write_bytes(b"\0\1")
+    git("add", ".")
+    git("commit", "-q", "-m", "1")
+    (tmp_path / "a.c").write_text("int a;\nstrcpy(a, b);\n\nint c;\n+++ x;\n")
+    (tmp_path / "c.bin").write_bytes(b"\0\2")
+    git("mv", "b.cpp", "d.cpp")
+    git("commit", "-q", "-a", "-m", "2")
+    settings = pokalint.Settings("./pokalint_settings.json")
+    changes = list(pokalint.git_changes("HEAD~1..HEAD", settings, str(tmp_path)))
+    assert(changes == [("a.c", [(0, 2, 1), (1, 3, 0), (0, 5, 1)], ["int a;", "strcpy(a, b);", "", "int c;", "+++ x;"])])
+    (tmp_path / "d.cpp").write_text("int main() {\n  return 0;\n}\nint x = atoi(s);\n")
+    (tmp_path / "e.c").write_text("int e;\n")
+    monkeypatch.chdir(str(tmp_path))
+    inspector = pokalint.Inspector(settings)
+    for path, hunks, lines in pokalint.git_changes("HEAD~1", settings):
+        inspector.inspect_hunks(path, hunks, lines)
+    r = inspector.report
+    assert(r.pure_added_line_count == 3 and r.pure_deleted_line_count == 1)
+    assert([(d["file"], d["line"], d["text"]) for d in r.warning_data()] == [("a.c", 2, "strcpy(a, b);"), ("d.cpp", 4, "int x = atoi(s);")])
+    assert(sorted(pokalint.os.path.basename(p) for p in pokalint.git_changed_files("HEAD")) == ["d.cpp", "e.c"])
+    (tmp_path / "sub").mkdir()
+    assert(sorted(pokalint.os.path.basename(p) for p in pokalint.git_changed_files("HEAD", str(tmp_path / "sub"))) == ["d.cpp", "e.c"])
+    pokalint.main(["pokalint.py", "-v", "--changed-since", "HEAD"])
+    o, e = capfd.readouterr()
+    assert("d.cpp:4" in o and "e.c (ascii)" in e and "a.c" not in e)
+
+def test_server(tmp_path):
+    import io
+    import threading
+    import pokalint_client
+    socket_path = str(tmp_path / "pokalint.sock")
+    server = pokalint.Server(pokalint.os.path.abspath("pokalint_settings.json"))
+    threading.Thread(target=server.serve, args=(socket_path,), daemon=True).start()
+    while not pokalint.os.path.exists(socket_path):
+        pokalint.time.sleep(0.01)
+    def request(argv, stdin=None, status=0):
+        o, e = io.StringIO(), io.StringIO()
+        assert(pokalint_client.request(socket_path, argv, stdin, o, e) == status)
+        return o.getvalue(), e.getvalue()
+    o, e = request(["test/*"])
+    verify_output(o, e, [18, 17, 19])
+    assert(request(["test/*"]) == (o, e))
+    with open("test/diff_git.txt", mode="rb") as f:
+        o, e = request([], f)
+    verify_output(o, e, [4, 2, 4])
+    # Streamed in chunks, or left unread by a failed request
+    with open("test/diff_git.txt", mode="rb") as f:
+        diff = f.read()
+    assert("# Deprecated (4000)" in request([], io.BytesIO(diff * 1000))[0])
+    assert("invalid choice" in request(["--format", "xml"], io.BytesIO(diff * 1000), status=2)[1])
+    source = tmp_path / "a.c"
+    source.write_text("int a = atoi(s);\n")
+    assert(re.search("Deprecated +- +1 ", request([str(source)])[0]))
+    source.write_text("int a = atoi(s);\nint b = atoi(s);\n")
+    assert(re.search("Deprecated +- +2 ", request([str(source)])[0]))
+    # Failed requests are replied, and the server goes on
+    assert("invalid choice" in request(["--format", "xml"], status=2)[1])
+    assert("usage:" in request(["stats", "--help"])[0])
+    assert("No lines" in request(["rules-bench", str(tmp_path / "none")], status=2)[1])
+    assert(re.search("Deprecated +- +2 ", request([str(source)])[0]))
+
+def test_memory_cache():
+    report = pokalint.Report(pokalint.Settings("./pokalint_settings.json"))
+    size = len(pokalint.pickle.dumps(report, pokalint.pickle.HIGHEST_PROTOCOL))
+    cache = pokalint.MemoryCache(size * 2)
+    keys = [(("options", "test/" + name), 1, 1) for name in ["a.c", "b.c", "c.c"]]
+    cache.put(keys[0], report)
+    cache.put(keys[1], report)
+    assert(cache.get(keys[0]) is not None and cache.get(keys[1]) is not None)
+    assert(cache.get(keys[0]) is not None)
+    # Over the size, the least recently used one is dropped
+    cache.put(keys[2], report)
+    assert(cache.get(keys[1]) is None and cache.get(keys[0]) is not None and len(cache) == 2)
+
+def test_settings_bundle(tmp_path):
+    path = str(tmp_path / "pokalint_settings.json")
+    root = settings_root()
+    with open(path, mode="w", encoding="utf-8") as f:
+        pokalint.json.dump(root, f)
+    bundle_path = pokalint.Settings(path).write_bundle(path)
+    assert(bundle_path == str(tmp_path / "pokalint_settings.bundle"))
+    settings = pokalint.Settings.load(path)
+    assert(settings.warning.match("a = atoi(s);", "c")["name"] == "Deprecated")
+    assert(settings.filetype("a.cpp") and settings.funcinfo_available)
+    # A changed settings file is loaded instead of the bundle
+    root["warning"]["Typo"].append("fixme")
+    with open(path, mode="w", encoding="utf-8") as f:
+        pokalint.json.dump(root, f)
+    assert(pokalint.Settings.load(path).warning.match("// fixme")["name"] == "Typo")
+    # A broken bundle is ignored
+    pokalint.Settings(path).write_bundle(path)
+    with open(bundle_path, mode="r+b") as f:
+        f.seek(-8, 2)
+        f.truncate()
+    assert(pokalint.Settings.load(path).warning.match("// fixme")["name"] == "Typo")
+    # A bundle referring to a class that is gone
+    with open(bundle_path, mode="r+b") as f:
+        f.readline()
+        f.truncate()
+        f.write(b"cpokalint\nNoSuchClass\n.")
+    assert(pokalint.Settings.load(path).warning.match("// fixme")["name"] == "Typo")
+
+def test_warning_text(tmp_path):
+    settings = pokalint.Settings("./pokalint_settings.json")
+    path = tmp_path / "a.c"
+    path.write_bytes("// サンプル\r\nx = atoi(s);\r\n\r\ny = atoi(t); /* é */\r\n".encode("utf-8") + b"int z;\r\n" * 1000)
+    for mmap_threshold in (None, 0):
+        inspector = pokalint.Inspector(settings, mmap_threshold=mmap_threshold)
+        inspector.inspect_file(str(path))
+        report = inspector.report
+        warnings = report.warning_data()
+        assert([w["text"] for w in warnings] == ["x = atoi(s);", "y = atoi(t); /* é */"])
+
+def test_decode_bytes():
+    expected = {
+        "helloworld.c":"utf-8", "helloworld_utf8bom.c":"utf-8-sig", "helloworld_sjis.c":"cp932",
+        "helloworld_eucjp.c":"euc_jp", "helloworld_utf16.c":"utf-16", "helloworld_utf16be.c":"utf-16"}
+    for name in expected:
+        with open("test/" + name, mode="rb") as f:
+            text, encoding = pokalint.decode_bytes(f.read())
+        assert(encoding == expected[name])
+        assert(text.startswith("// サンプルプログラム"))
+    # Shift_JIS after a UTF-8 compatible sample
+    data = b"int a;\n" * 10000 + "// サンプル\n".encode("cp932")
+    assert(pokalint.decode_bytes(data, 1024) == (data.decode("cp932"), "cp932"))
+    assert(pokalint.detect_encoding(b"int a;") == "ascii")
+    assert(pokalint.detect_encoding("a = 1;".encode("utf-16-le")) == "utf-16-le")
+    assert(pokalint.split_lines("a\r\nb\rc\nd\x0ce\n") == ["a", "b", "c", "d\x0ce"])
+
+def test_main_stdin_encodings(capfd):
+    for name in ["diff_git_bom.txt", "diff_git_sjis.txt", "diff_git_utf16.txt"]:
+        with open("test/" + name, mode="rb") as f:
+            lines = pokalint.DecodedLines(f, 64)
+            pokalint.main(["pokalint.py"], lines)
+        o, e = capfd.readouterr()
+        verify_output(o, e, [4, 2, 3])
+
+def test_inspector_mmap(tmp_path, capfd):
+    settings = pokalint.Settings("./pokalint_settings.json")
+    path = tmp_path / "large.cpp"
+    with open("test/helloworld.cpp", mode="rb") as f:
+        path.write_bytes(f.read() * 100 + "\t// ほげ strcpy(a, b); cash\r\nint x = {0};".encode("utf-8"))
+    outputs = []
+    for mmap_threshold in [None, 0]:
+        inspector = pokalint.Inspector(settings, mmap_threshold=mmap_threshold)
+        inspector.inspect_file(str(path))
+        inspector.report.output(pokalint.Output(pokalint.sys.stdout))
+        outputs.append(capfd.readouterr()[0])
+    assert("strcpy" in outputs[1])
+    assert(outputs[0] == outputs[1])
+    # The first line after a BOM and an empty file
+    bom_path = tmp_path / "bom.c"
+    bom_path.write_bytes(pokalint.codecs.BOM_UTF8 + b"int main(void)\r\n{\r\n\tstrcpy(a, b);\r\n}\r\n")
+    empty_path = tmp_path / "empty.c"
+    empty_path.write_bytes(b"")
+    data = []
+    for mmap_threshold in [None, 0]:
+        inspector = pokalint.Inspector(settings, mmap_threshold=mmap_threshold)
+        inspector.inspect_file(str(bom_path))
+        inspector.inspect_file(str(empty_path))
+        data.append(inspector.report.data())
+    assert(data[1]["funcdefs"] == ["main"])
+    assert(data[0] == data[1])
+
+def test_report_max_warnings(capfd):
+    settings = pokalint.Settings("./pokalint_settings.json")
+    inspector = pokalint.Inspector(settings, max_warnings=1)
+    inspector.inspect_file("test/helloworld.c")
+    inspector.inspect_file("test/helloworld_sjis.c")
+    r = inspector.report
+    assert(r.warning_count("Deprecated") == 4)
+    r.output(pokalint.Output(pokalint.sys.stdout))
+    o, e = capfd.readouterr()
+    assert("# Deprecated (4, first 1 shown)" in o)
+    assert(" int b = atoi(\"1\");" in o)
+    verify_output(o, e, [4, 4, 4])
+
+def test_main_format(capfd):
+    pokalint.main(["pokalint.py", "test/helloworld.c", "--format", "jsonl"])
+    o, e = capfd.readouterr()
+    records = [pokalint.json.loads(line) for line in o.splitlines()]
+    assert([r["type"] for r in records] == ["warning", "warning", "summary", "counts", "funcdefs", "funccalls", "warning_counts"])
+    assert(records[0]["line"] == 8 and records[0]["match"] == "atoi")
+    assert(records[-1]["warning_counts"]["Deprecated"] == 2)
+    pokalint.main(["pokalint.py", "--format", "sarif"], open("test/diff_git.txt", encoding="utf-8"))
+    o, e = capfd.readouterr()
+    run = pokalint.json.loads(o)["runs"][0]
+    assert(len(run["results"]) == 6)
+    assert(run["properties"]["counts"]["if"] == 4)
+    pokalint.main(["pokalint.py", "test/*", "--format", "json"])
+    o, e = capfd.readouterr()
+    doc = pokalint.json.loads(o)
+    assert(len(doc["warnings"]) == 19)
+    assert(doc["warning_counts"]["Deprecated"] == 19)
+    # A failed run still makes a whole document
+    for format in ("json", "sarif", "jsonl"):
+        assert(pokalint.main(["pokalint.py", "--format", format], ["not a diff\n"] * 4) == 2)
+        o, e = capfd.readouterr()
+        assert("Invalid diff format" in e)
+        doc = pokalint.json.loads(o)
+        error = doc.get("error") or doc.get("runs", [{}])[0].get("invocations", [{}])[0].get("toolExecutionNotifications")
+        assert(error and not doc.get("warnings"))
+
+def test_bench():
+    import bench_pokalint
+    result = bench_pokalint.run(files=2, lines=50, rules=10, diff_files=2, repeat=1)
+    assert(list(result["stages"]) == ["settings", "settings_bundle", "inspect_file", "inspect_diff", "output"])
+    assert(0 < result["stages"]["inspect_file"]["lines_per_sec"])
+    lines, regressed = bench_pokalint.compare(result, result, 0.2)
+    assert(len(lines) == 5 and not regressed)
+
+def test_main_profile_rules(capfd):
+    pokalint.main(["pokalint.py", "test/helloworld.c", "--profile-rules", "--profile-threshold", "0"])
+    o, e = capfd.readouterr()
+    verify_output(o, "", [2, 2, 2])
+    assert("# Rule profile" in e)
+    assert(re.search(r"warning/Deprecated \\bstrcmp\\b +- +[\d.]+ ms +27 calls +1 hits", e))
+    assert(re.search(r"function/call .* - +[\d.]+ ms", e))
+    assert("rule(s) took more than 0.0 ms for a line." in e)